@@ -1,4 +1,25 @@
 #!/usr/bin/env bash
 python3 manage.py collectstatic --noinput
-python3 manage.py migrate --noinput
-gunicorn --bind 0.0.0.0:8000 pizzapool.wsgi
\ No newline at end of file
+# Fail fast on a bad database configuration (events/checks.py). Migrations may build large indexes, so they run
+# without the statement timeout
+python3 manage.py check --database default || exit 1
+DB_STATEMENT_TIMEOUT=0 python3 manage.py migrate --noinput
+python3 manage.py backfill_phone_display
+# Metrics shared between the gunicorn and task worker processes (events/metrics.py), cleared on each start
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+# Background task workers (queued emails and Stripe calls, see events/tasks.py)
+python3 manage.py run_workers &
+workers=$!
+# ASGI (uvicorn) workers by default, so live event streams (events.live) and the async pages don't hold a whole sync
+# worker. SERVER_MODE=wsgi switches to threaded sync workers, see gunicorn.conf.py
+gunicorn --config gunicorn.conf.py &
+server=$!
+# Stop both on docker stop, and stop the container when either exits so its restart policy brings both back,
+# rather than serving pages while queued emails and Stripe calls pile up
+trap 'kill -TERM $workers $server 2>/dev/null' TERM INT
+wait -n
+status=$?
+kill -TERM $workers $server 2>/dev/null
+wait
+exit $status
@@ -2,12 +2,9 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.forms import forms
-from django.conf import settings
-import stripe
 
-from .models import Organisation, OrgUser, Event, Order, Serving
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from . import payments, tasks
+from .models import Organisation, OrgUser, Event, EventArchive, Order, Serving, Task
 
 
 class CustomUserChangeForm(UserChangeForm):
@@ -63,16 +60,66 @@ class CustomUserAdmin(UserAdmin):
 
 
 class OrganisationAdmin(admin.ModelAdmin):
-    readonly_fields = ['path', 'stripe_account_id', 'stripe_account_verified']
+    list_display = ['name', 'path', 'stripe_provisioning_status', 'stripe_account_verified']
+    list_filter = ['stripe_provisioning_status', 'stripe_account_verified']
+    readonly_fields = ['path', 'stripe_account_id', 'stripe_provisioning_status', 'stripe_account_verified']
+    actions = ['retry_stripe_provisioning']
 
     def save_model(self, request, obj, form, change):
-        response = stripe.Account.create()
-        obj.stripe_account_id = response['id']
         super().save_model(request, obj, form, change)
+        # Account creation runs in the background, and only for organisations without an account
+        payments.schedule_account_provisioning(obj)
+
+    @admin.action(description="Retry Stripe account provisioning")
+    def retry_stripe_provisioning(self, request, queryset):
+        queued = sum(payments.schedule_account_provisioning(org) for org in queryset)
+        self.message_user(request, f"Queued Stripe account provisioning for {queued} organisation(s).")
+
+
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ['purchaser_name', 'purchaser_whatsapp_display', 'description', 'event']
+    list_select_related = ['event__organisation']
+
+    def get_queryset(self, request):
+        # The list shows the stored display strings, so skip parsing every row's number
+        return super().get_queryset(request).defer('purchaser_whatsapp')
+
+
+class ServingAdmin(admin.ModelAdmin):
+    list_display = ['buyer_name', 'buyer_whatsapp_display', 'number_of_servings', 'order']
+    list_select_related = ['order']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('buyer_whatsapp')
+
+
+class EventArchiveAdmin(admin.ModelAdmin):
+    list_display = ['name', 'organisation', 'date', 'archived_at']
+    list_select_related = ['organisation']
+    search_fields = ['name', 'slug']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'max_attempts', 'run_at', 'created_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['name', 'args', 'kwargs', 'attempts', 'started_at', 'last_error', 'created_at']
+    actions = ['requeue_tasks']
+
+    @admin.action(description="Requeue dead tasks")
+    def requeue_tasks(self, request, queryset):
+        self.message_user(request, f"Requeued {tasks.requeue(queryset)} task(s).")
 
 
 admin.site.register(Organisation, OrganisationAdmin)
 admin.site.register(OrgUser, CustomUserAdmin)
 admin.site.register(Event)
-admin.site.register(Order)
-admin.site.register(Serving)
+admin.site.register(Order, OrderAdmin)
+admin.site.register(Serving, ServingAdmin)
+admin.site.register(EventArchive, EventArchiveAdmin)
+admin.site.register(Task, TaskAdmin)
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class EventsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'events'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+        from django.conf import settings
+        if settings.METRICS_ENABLED:
+            from . import metrics
+            metrics.instrument_stripe()
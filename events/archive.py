@@ -0,0 +1,57 @@
+"""
+Archival of past events.
+
+archive_events() moves events dated more than EVENT_ARCHIVE_AFTER_DAYS ago into EventArchive, one summary row per
+event, and deletes the event with its orders and servings, so the live tables (and their indexes) only grow with
+recent events and old buyers' phone numbers and emails aren't kept. Each batch is one transaction. The event page
+and the organisation's past events list then read the archive (see EventDetailView and OrgDetailView).
+"""
+from django.db import transaction
+from django.db.models import Count
+
+from .models import Event, EventArchive, Order, Serving, touch_organisation
+
+
+def summarise_orders(event_ids):
+    """The archived order summaries of each of event_ids, in one query"""
+    summaries = {event_id: [] for event_id in event_ids}
+    orders = Order.objects.filter(event_id__in=event_ids).annotate(buyers=Count('serving')).order_by('pk').values(
+        'event_id', 'purchaser_name', 'description', 'price_per_serving', 'available_servings', 'claimed_servings',
+        'buyers')
+    for order in orders:
+        event_id = order.pop('event_id')
+        order['price_per_serving'] = str(order['price_per_serving'])
+        summaries[event_id].append(order)
+    return summaries
+
+
+def archive_batch(cutoff, batch_size):
+    """Archives up to batch_size events dated before cutoff, returning how many were archived"""
+    with transaction.atomic():
+        # Locked rows are being claimed from or archived by another run, they're picked up next time
+        events = list(Event.objects.filter(date__lt=cutoff).order_by('pk').select_for_update(skip_locked=True)[
+            :batch_size])
+        if not events:
+            return 0
+        event_ids = [event.pk for event in events]
+        summaries = summarise_orders(event_ids)
+        EventArchive.objects.bulk_create(
+            EventArchive(organisation_id=event.organisation_id, slug=event.slug, name=event.name, date=event.date,
+                         description=event.description, private=event.private, locked=event.locked,
+                         servings_per_order=event.servings_per_order, orders=summaries[event.pk])
+            for event in events)
+        # Set-based deletes without signals, as in cascade_delete(): the pages stay up from the archive
+        for queryset in (Serving.objects.filter(order__event_id__in=event_ids),
+                         Order.objects.filter(event_id__in=event_ids), Event.objects.filter(pk__in=event_ids)):
+            queryset._raw_delete(queryset.db)
+        for organisation_id in {event.organisation_id for event in events}:
+            transaction.on_commit(lambda organisation_id=organisation_id: touch_organisation(organisation_id))
+    return len(events)
+
+
+def archive_events(cutoff, batch_size=100):
+    """Archives every event dated before cutoff, batch_size per transaction, returning how many were archived"""
+    archived = 0
+    while batch := archive_batch(cutoff, batch_size):
+        archived += batch
+    return archived
@@ -0,0 +1,40 @@
+"""
+Authentication backend loading the logged in user with their organisation joined, and caching them for
+PRINCIPAL_CACHE_TIMEOUT seconds so authenticated requests don't query for either. Cached users are forgotten after
+commit whenever they or their organisation change, see signals.py and the queryset updates in payments.py. The cache
+must be shared by all processes for that to reach them, so caching is off with a local memory cache.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+
+
+def principal_key(user_id):
+    return f"principal:{user_id}"
+
+
+class CachedPrincipalBackend(ModelBackend):
+    def get_user(self, user_id):
+        key = principal_key(user_id)
+        user = cache.get(key) if settings.PRINCIPAL_CACHE_TIMEOUT else None
+        if user is None:
+            user = get_user_model()._default_manager.select_related('organisation').filter(pk=user_id).first()
+            if user is None:
+                return None
+            if settings.PRINCIPAL_CACHE_TIMEOUT:
+                cache.set(key, user, settings.PRINCIPAL_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+
+def forget_principals(user_ids):
+    keys = [principal_key(pk) for pk in user_ids]
+    # After commit, so a request can't cache the old row again in between
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def forget_organisation_principals(organisations):
+    """Forgets the cached users of the organisations in a queryset"""
+    forget_principals(list(get_user_model()._default_manager.filter(organisation__in=organisations).values_list(
+        'pk', flat=True)))
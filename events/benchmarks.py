@@ -0,0 +1,107 @@
+"""
+Times the main pages through the Django test client against the data already in the database (see the
+seed_benchmark_data command), recording latency percentiles and query counts so that runs can be compared with a
+stored baseline. Run with the run_benchmarks command.
+"""
+import math
+import statistics
+import time
+from typing import NamedTuple, Optional
+
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import Event, Order, Organisation, OrgUser
+
+
+class Scenario(NamedTuple):
+    name: str
+    url: str
+    user: Optional[OrgUser] = None
+
+
+def default_scenarios():
+    """
+    The organisation, event, order and claim pages for the busiest organisation and event in the database, so the
+    results track the worst case as the dataset grows. The organisation page is also timed for one of its users if
+    it has any, as they see its private events.
+    """
+    org = Organisation.objects.annotate(events=Count('event')).order_by('-events', 'pk').first()
+    event = Event.objects.annotate(orders=Count('order')).order_by('-orders', 'pk').select_related(
+        'organisation').first()
+    if org is None or event is None:
+        return []
+    scenarios = [
+        Scenario("home", reverse("events:home")),
+        Scenario("org_detail", reverse("events:org-detail", args=[org.path])),
+        Scenario("event_detail", reverse("events:event-detail", args=[event.organisation.path, event.slug])),
+        Scenario("order_create", reverse("events:create-pizza-order", args=[event.organisation.path, event.slug])),
+    ]
+    user = OrgUser.objects.filter(organisation=org).first()
+    if user is not None:
+        scenarios.append(Scenario("org_detail_member", reverse("events:org-detail", args=[org.path]), user))
+    order = Order.objects.filter(event=event).order_by('pk').first()
+    if order is not None:
+        scenarios.append(Scenario("claim_servings", reverse("events:claim-servings",
+                                                            args=[event.organisation.path, order.pk])))
+    return scenarios
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of samples"""
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def run_scenario(scenario, iterations=50, warmup=5):
+    """Requests the scenario's URL warmup + iterations times, returning latencies in milliseconds and query counts"""
+    client = Client()
+    if scenario.user is not None:
+        client.force_login(scenario.user)
+    timings = []
+    queries = []
+    for i in range(warmup + iterations):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = client.get(scenario.url)
+            elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"{scenario.name}: GET {scenario.url} returned {response.status_code}")
+        if i >= warmup:
+            timings.append(elapsed)
+            queries.append(len(captured))
+    return {
+        "url": scenario.url,
+        "iterations": iterations,
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "max_ms": round(max(timings), 3),
+        "queries": max(queries),
+    }
+
+
+def run_benchmarks(scenarios=None, iterations=50, warmup=5):
+    """Runs each scenario in turn, returning {scenario name: results}"""
+    if scenarios is None:
+        scenarios = default_scenarios()
+    return {scenario.name: run_scenario(scenario, iterations, warmup) for scenario in scenarios}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Lists the regressions of results against a baseline from an earlier run: any increase in query count, or a p95
+    latency more than tolerance (a fraction) above the baseline's. Scenarios missing from either side are ignored.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["queries"] > previous["queries"]:
+            regressions.append(f"{name}: {result['queries']} queries, baseline {previous['queries']}")
+        if result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms, baseline {previous['p95_ms']}ms")
+    return regressions
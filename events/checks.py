@@ -0,0 +1,69 @@
+"""
+Startup checks of the database connection settings (see DB_* in settings.py). The configuration checks run with every
+management command; check_database_session also connects and runs with migrate or check --database default.
+"""
+import importlib.util
+
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+from django.db import connections
+
+
+@register()
+def check_connection_settings(app_configs, **kwargs):
+    db = settings.DATABASES['default']
+    max_age = db.get('CONN_MAX_AGE', 0)
+    pool = db.get('OPTIONS', {}).get('pool')
+    errors = []
+    if pool and importlib.util.find_spec('psycopg') is None:
+        errors.append(Error("DB_POOL needs psycopg 3 and psycopg-pool installed.", id="events.E001"))
+    if pool and max_age:
+        errors.append(Error("DB_POOL can't be combined with persistent connections, set DB_CONN_MAX_AGE=0.",
+                            id="events.E002"))
+    if settings.SERVER_MODE == 'asgi' and max_age:
+        errors.append(Error(
+            "Persistent connections leak under ASGI, where each request runs in a new thread.",
+            hint="Set DB_CONN_MAX_AGE=0 and use DB_POOL or PgBouncer instead.", id="events.E003"))
+    if settings.DB_PGBOUNCER and pool:
+        errors.append(Warning("DB_POOL behind PgBouncer pools connections twice.", id="events.W001"))
+    if settings.DB_PGBOUNCER and settings.LIVE_UPDATES_BROKER == 'postgres':
+        errors.append(Warning(
+            "LISTEN/NOTIFY live updates need a session, which PgBouncer in transaction mode doesn't keep.",
+            hint="Point DB_HOST at PostgreSQL directly for the live updates listener, or use session pooling.",
+            id="events.W002"))
+    if settings.LIVE_UPDATES_BROKER == 'inprocess' and settings.WEB_CONCURRENCY > 1:
+        errors.append(Error(
+            "The inprocess live updates broker only reaches viewers connected to the worker that made the change.",
+            hint="Set LIVE_UPDATES_BROKER=postgres, or WEB_CONCURRENCY=1.", id="events.E005"))
+    if settings.PRINCIPAL_CACHE_TIMEOUT and settings.CACHES['default']['BACKEND'] in settings.LOCAL_CACHE_BACKENDS:
+        errors.append(Error(
+            "Cached users can't be invalidated in other processes with a local memory cache.",
+            hint="Set CACHE_BACKEND to a shared cache, or PRINCIPAL_CACHE_TIMEOUT=0.", id="events.E006"))
+    if settings.MICROCACHE_PURGE_URL and not settings.MICROCACHE_REFRESH_SECRET:
+        errors.append(Warning(
+            "Cached pages aren't refreshed after writes without MICROCACHE_REFRESH_SECRET.",
+            hint="Set MICROCACHE_REFRESH_SECRET for both django-web and nginx.", id="events.W005"))
+    if settings.REPLICA_DATABASES and settings.REPLICA_STICKY_SECONDS < settings.REPLICA_MAX_LAG:
+        errors.append(Warning(
+            "Clients can stop reading from the primary before replicas have caught up with their writes.",
+            hint="Set REPLICA_STICKY_SECONDS to at least REPLICA_MAX_LAG.", id="events.W004"))
+    return errors
+
+
+@register(Tags.database)
+def check_database_session(app_configs, databases=None, **kwargs):
+    """Connects and confirms the server applies DB_STATEMENT_TIMEOUT, which PgBouncer can't pass on"""
+    if not databases or 'default' not in databases:
+        return []
+    try:
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SHOW statement_timeout")
+            timeout = cursor.fetchone()[0]
+    except Exception as e:
+        return [Error(f"Could not connect to the database: {e}", id="events.E004")]
+    if settings.DB_STATEMENT_TIMEOUT and timeout == "0":
+        return [Warning(
+            "Queries have no statement timeout.",
+            hint=f"With DB_PGBOUNCER set it on the role: ALTER ROLE ... SET statement_timeout = "
+                 f"{settings.DB_STATEMENT_TIMEOUT}.", id="events.W003")]
+    return []
@@ -38,8 +38,8 @@ class EventEditForm(forms.ModelForm):
 class OrderCreateForm(forms.ModelForm):
     class Meta:
         model = Order
-        fields = ['purchaser_name', 'purchaser_whatsapp', 'purchaser_revolut', 'description', 'price_per_serving',
-                  'available_servings']
+        fields = ['purchaser_name', 'purchaser_whatsapp', 'purchaser_email', 'purchaser_revolut', 'description',
+                  'price_per_serving', 'available_servings']
         error_messages = {
             'purchaser_whatsapp': {
                 'invalid': "Enter a valid phone number (e.g. 087 123 4567) or a number with an international call prefix.",
@@ -67,7 +67,7 @@ class OrderCreateForm(forms.ModelForm):
 class ServingCreateForm(forms.ModelForm):
     class Meta:
         model = Serving
-        fields = "buyer_name", "buyer_whatsapp", "number_of_servings"
+        fields = "buyer_name", "buyer_whatsapp", "buyer_email", "number_of_servings"
         error_messages = {
             'buyer_whatsapp': {
                 'invalid': "Enter a valid phone number (e.g. 087 123 4567) or a number with an international call prefix.",
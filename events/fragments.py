@@ -0,0 +1,48 @@
+"""
+Cached order cards for the event page.
+
+Each card is rendered from events/order_card.html and cached under a key built from the order's version and
+updated_at, which every write to the order or its servings changes (see order_changed()), plus the event state the
+card shows. A write therefore invalidates only its own card, and a page whose cards are all cached doesn't load any
+servings.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import prefetch_related_objects
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import servings_prefetch
+
+
+def order_card_key(order):
+    event = order.event
+    return (f"order-card:{order.pk}:{order.version}:{order.updated_at.timestamp()}:"
+            f"{int(event.locked)}:{event.organisation.path}")
+
+
+def render_order_cards(orders):
+    """The cards of orders, loading their servings first"""
+    prefetch_related_objects(orders, servings_prefetch())
+    return [render_to_string("events/order_card.html", {"order": order, "event": order.event}) for order in orders]
+
+
+async def aattach_order_cards(orders):
+    """
+    Sets card_html on each of orders (from Order.objects.with_claim_stats(servings=False)), rendering and caching
+    only the cards that aren't already cached. Cards are rendered in a thread, off the event loop.
+    """
+    cache = caches[settings.ORDER_CARD_CACHE]
+    keys = {order.pk: order_card_key(order) for order in orders}
+    cached = await cache.aget_many(keys.values())
+    missing = [order for order in orders if keys[order.pk] not in cached]
+    rendered = {}
+    if missing:
+        cards = await sync_to_async(render_order_cards)(missing)
+        rendered = {keys[order.pk]: card for order, card in zip(missing, cards)}
+    await cache.aset_many(rendered, settings.ORDER_CARD_CACHE_TIMEOUT)
+    cached.update(rendered)
+    for order in orders:
+        order.card_html = mark_safe(cached[keys[order.pk]])
+    return orders
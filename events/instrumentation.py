@@ -0,0 +1,123 @@
+"""
+Hooks shared by the request profiler (events.profiling) and the Prometheus metrics (events.metrics): a single wrapper
+around the Stripe HTTP client and a single execute_wrapper per request, each reporting to the observers registered
+with it, so enabling both doesn't stack two layers of timing.
+"""
+import time
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+import stripe
+
+_stripe_observers = []
+_query_observers = ContextVar("query_observers", default=None)
+
+
+class InstrumentedStripeClient:
+    """
+    Wraps a Stripe HTTP client, timing each request (retries included) and calling the registered observers with
+    observer(duration, status, error): the HTTP status, or None and the exception if the request raised.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.request_with_retries = self._observed(client.request_with_retries)
+        self.request_stream_with_retries = self._observed(client.request_stream_with_retries)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @staticmethod
+    def _observed(method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = error = None
+            try:
+                content, status, headers = method(*args, **kwargs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                for observer in _stripe_observers:
+                    observer(duration, status, error)
+            return content, status, headers
+        return wrapper
+
+
+def observe_stripe(observer):
+    """Registers observer to be called after every Stripe request, wrapping the Stripe HTTP client once per process"""
+    if observer not in _stripe_observers:
+        _stripe_observers.append(observer)
+    if not isinstance(stripe.default_http_client, InstrumentedStripeClient):
+        stripe.default_http_client = InstrumentedStripeClient(
+            stripe.default_http_client or stripe.new_default_http_client())
+
+
+class QueryObservers(list):
+    """execute_wrapper calling each observer with observer(sql, duration) after every query"""
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            for observer in self:
+                observer(sql, duration)
+
+
+def wrap_connections(wrapper):
+    """Installs an execute_wrapper on every database connection of the current thread until the stack is closed"""
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(wrapper))
+    return stack
+
+
+@contextmanager
+def observe_queries(observer):
+    """
+    Calls observer(sql, duration) for each query run in the block. Nested blocks (the profiling and metrics
+    middleware) share the outermost block's execute_wrapper rather than installing their own.
+    """
+    observers = _query_observers.get()
+    if observers is not None:
+        observers.append(observer)
+        try:
+            yield
+        finally:
+            observers.remove(observer)
+        return
+    observers = QueryObservers([observer])
+    token = _query_observers.set(observers)
+    try:
+        with wrap_connections(observers):
+            yield
+    finally:
+        _query_observers.reset(token)
+
+
+@asynccontextmanager
+async def aobserve_queries(observer):
+    """observe_queries for async requests, whose queries run in the request's sync thread"""
+    observers = _query_observers.get()
+    if observers is not None:
+        observers.append(observer)
+        try:
+            yield
+        finally:
+            observers.remove(observer)
+        return
+    observers = QueryObservers([observer])
+    token = _query_observers.set(observers)
+    try:
+        wrappers = await sync_to_async(wrap_connections)(observers)
+        try:
+            yield
+        finally:
+            await sync_to_async(wrappers.close)()
+    finally:
+        _query_observers.reset(token)
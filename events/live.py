@@ -0,0 +1,163 @@
+"""
+Live event page updates.
+
+Writes to an event's orders and servings are published as small JSON deltas once their transaction commits. Viewers
+of an event page subscribe through an async server-sent events endpoint. With LIVE_UPDATES_BROKER = "postgres" the
+deltas go through Postgres LISTEN/NOTIFY so every worker process sees every write; with "inprocess" they are only
+fanned out within the current process, which is enough for a single worker.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "pizzapool_event_updates"
+QUEUE_SIZE = 100
+
+
+class InProcessBroker:
+    """Fans deltas out to the asyncio queues of viewers subscribed in this process"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, event_id):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(event_id, set()).add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, event_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(event_id, set())
+            subscribers.difference_update({s for s in subscribers if s[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(event_id, None)
+
+    def publish(self, event_id, delta):
+        self.deliver(event_id, delta)
+
+    def deliver(self, event_id, delta):
+        with self._lock:
+            subscribers = list(self._subscribers.get(event_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, delta)
+
+
+class PostgresBroker(InProcessBroker):
+    """
+    Publishes deltas with NOTIFY and runs one LISTEN thread per process, which hands notifications to the local
+    subscribers. The listener is started on the first subscription, on a psycopg2 connection of its own rather than
+    one from Django's connection pool, as LISTEN lasts for the whole session.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+
+    def subscribe(self, event_id):
+        self._ensure_listener()
+        return super().subscribe(event_id)
+
+    def publish(self, event_id, delta):
+        payload = json.dumps({"event_id": event_id, "delta": delta})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, payload])
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen_forever, name="live-updates-listener",
+                                                  daemon=True)
+                self._listener.start()
+
+    def _listen_forever(self):
+        backoff = 1
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Live updates listener lost its connection, reconnecting in %ss", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def _listen(self):
+        db = connections["default"].settings_dict
+        raw = psycopg2.connect(dbname=db["NAME"], user=db["USER"] or None, password=db["PASSWORD"] or None,
+                               host=db["HOST"] or None, port=db["PORT"] or None)
+        try:
+            raw.autocommit = True
+            with raw.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            while True:
+                if select.select([raw], [], [], 30) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    notification = raw.notifies.pop(0)
+                    message = json.loads(notification.payload)
+                    self.deliver(message["event_id"], message["delta"])
+        finally:
+            raw.close()
+
+
+def _offer(queue, delta):
+    """Queues a delta for a viewer; a viewer that has fallen too far behind is told to reload instead"""
+    try:
+        queue.put_nowait(delta)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait({"type": "resync"})
+
+
+_brokers = {"inprocess": InProcessBroker, "postgres": PostgresBroker}
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = _brokers[settings.LIVE_UPDATES_BROKER]()
+    return _broker
+
+
+def publish_on_commit(event_id, build_delta):
+    """Publishes the delta returned by build_delta() for an event once the current transaction commits"""
+    def publish():
+        try:
+            get_broker().publish(event_id, build_delta())
+        except Exception:
+            logger.exception("Failed to publish live update for event %s", event_id)
+
+    transaction.on_commit(publish)
+
+
+def format_sse(delta):
+    return f"data: {json.dumps(delta)}\n\n"
+
+
+async def stream_deltas(event_id):
+    """Yields server-sent event messages for an event until the client disconnects"""
+    broker = get_broker()
+    queue = broker.subscribe(event_id)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                delta = await asyncio.wait_for(queue.get(), timeout=settings.LIVE_UPDATES_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            yield format_sse(delta)
+    finally:
+        broker.unsubscribe(event_id, queue)
@@ -0,0 +1,67 @@
+import base64
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .metrics import observe_email_send
+from .tasks import task
+
+
+def serialize_message(message) -> dict:
+    """Converts an EmailMessage (or EmailMultiAlternatives) to JSON-safe data for a task"""
+    attachments = []
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            filename, content, mimetype = (attachment.get_filename(), attachment.get_payload(decode=True),
+                                           attachment.get_content_type())
+        else:
+            filename, content, mimetype = attachment
+        if isinstance(content, str):
+            content = content.encode()
+        attachments.append([filename, base64.b64encode(content).decode(), mimetype])
+    return {
+        "subject": message.subject,
+        "body": message.body,
+        "from_email": message.from_email,
+        "to": message.to,
+        "cc": message.cc,
+        "bcc": message.bcc,
+        "reply_to": message.reply_to,
+        "headers": message.extra_headers,
+        "content_subtype": message.content_subtype,
+        "alternatives": [list(alternative) for alternative in getattr(message, "alternatives", [])],
+        "attachments": attachments,
+    }
+
+
+def deserialize_message(data, connection=None) -> EmailMessage:
+    message = EmailMultiAlternatives(
+        subject=data["subject"], body=data["body"], from_email=data["from_email"], to=data["to"], cc=data["cc"],
+        bcc=data["bcc"], reply_to=data["reply_to"], headers=data["headers"], connection=connection,
+        alternatives=[tuple(alternative) for alternative in data["alternatives"]],
+    )
+    message.content_subtype = data["content_subtype"]
+    for filename, content, mimetype in data["attachments"]:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    return message
+
+
+@task(max_attempts=5)
+def send_email(data):
+    """Sends a queued message through TASK_EMAIL_BACKEND"""
+    with observe_email_send(), get_connection(settings.TASK_EMAIL_BACKEND) as connection:
+        connection.send_messages([deserialize_message(data, connection)])
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """
+    Email backend that queues messages as background tasks instead of talking to the SMTP server during the
+    request. Covers everything sent through django.core.mail, including the password reset flow.
+    """
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            send_email.enqueue(serialize_message(message))
+        return len(email_messages)
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from events.archive import archive_events
+
+
+class Command(BaseCommand):
+    help = ("Moves events older than EVENT_ARCHIVE_AFTER_DAYS, with their orders and servings, into the event archive "
+            "in batched transactions. Run it daily, e.g. from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=int, default=settings.EVENT_ARCHIVE_AFTER_DAYS,
+                            help="Archive events dated more than this many days ago.")
+        parser.add_argument("--batch-size", type=int, default=100, help="Number of events archived per transaction.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["older_than_days"])
+        archived = archive_events(cutoff, options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} event(s) dated before {cutoff:%Y-%m-%d}."))
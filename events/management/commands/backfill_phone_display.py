@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from events.models import Order, Serving, format_phone, order_changed
+
+
+class Command(BaseCommand):
+    help = ("Stores the display format of order and serving WhatsApp numbers saved before it was stored on write, in "
+            "batches. Rows that already have it are skipped, so it is safe to run on every deploy.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of rows updated per transaction.")
+
+    def handle(self, *args, **options):
+        orders = self.backfill(Order.objects.all(), "purchaser_whatsapp", "pk", options["batch_size"])
+        servings = self.backfill(Serving.objects.all(), "buyer_whatsapp", "order_id", options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {orders} order(s) and {servings} serving(s)."))
+
+    def backfill(self, queryset, field, order_field, batch_size):
+        """Fills field's display column, marking the affected orders changed so their cards and pages re-render"""
+        display = f"{field}_display"
+        done = last_pk = 0
+        while True:
+            with transaction.atomic():
+                batch = list(queryset.filter(pk__gt=last_pk, **{display: ""}).order_by("pk").only(
+                    "pk", field, order_field)[:batch_size])
+                if not batch:
+                    return done
+                for row in batch:
+                    setattr(row, display, format_phone(getattr(row, field)))
+                queryset.model.objects.bulk_update(batch, [display])
+                order_ids = {getattr(row, order_field) for row in batch}
+                Order.objects.filter(pk__in=order_ids).update(**order_changed())
+            done += len(batch)
+            last_pk = batch[-1].pk
@@ -0,0 +1,64 @@
+import json
+import statistics
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from events.benchmarks import percentile
+
+
+class Command(BaseCommand):
+    help = ("Measures per-request database connection overhead: a connection opened for every request, a persistent "
+            "connection with health checks, and the configured DB_* settings (e.g. the psycopg 3 pool).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="Simulated requests per mode.")
+        parser.add_argument("--output", default="connection-benchmark.json", help="File the results are written to.")
+
+    def handle(self, *args, **options):
+        configured = connections["default"].settings_dict
+        modes = {
+            "per_request": {"CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": False,
+                            "OPTIONS": {k: v for k, v in configured["OPTIONS"].items() if k != "pool"}},
+            "persistent": {"CONN_MAX_AGE": None, "CONN_HEALTH_CHECKS": True,
+                           "OPTIONS": {k: v for k, v in configured["OPTIONS"].items() if k != "pool"}},
+            "configured": {},
+        }
+        results = {}
+        for mode, overrides in modes.items():
+            results[mode] = self.measure({**configured, **overrides}, options["requests"])
+            self.stdout.write(f"{mode}: mean {results[mode]['mean_ms']}ms, p95 {results[mode]['p95_ms']}ms "
+                              f"per request")
+        document = {"created_at": timezone.now().isoformat(), "results": results}
+        Path(options["output"]).write_text(json.dumps(document, indent=2))
+        self.stdout.write(f"Results written to {options['output']}")
+
+    def measure(self, settings_dict, requests):
+        """
+        Runs one query per simulated request, with the connection handling Django does at the start and end of each
+        request (close_if_unusable_or_obsolete), on a connection object of its own
+        """
+        connection = connections.create_connection("default")
+        connection.settings_dict = settings_dict
+        timings = []
+        try:
+            for _ in range(requests):
+                start = time.perf_counter()
+                connection.close_if_unusable_or_obsolete()
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+                connection.close_if_unusable_or_obsolete()
+                timings.append((time.perf_counter() - start) * 1000)
+        finally:
+            connection.close()
+            if hasattr(connection, "close_pool"):
+                connection.close_pool()
+        return {
+            "mean_ms": round(statistics.mean(timings), 3),
+            "p50_ms": round(percentile(timings, 50), 3),
+            "p95_ms": round(percentile(timings, 95), 3),
+        }
@@ -0,0 +1,50 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template.loader import render_to_string
+
+from events.models import Event, Order
+from events.testing_utils import bulk_seed
+
+
+class Command(BaseCommand):
+    help = ("Seeds a throwaway event with --servings servings and times loading and rendering its order cards with "
+            "the phone numbers parsed and formatted per row, against the stored display strings.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--servings", type=int, default=500, help="Servings on the event, 10 per order.")
+        parser.add_argument("--iterations", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            org, = bulk_seed(organisations=1, events_per_org=1, orders_per_event=max(options["servings"] // 10, 1),
+                             servings_per_order=10, seed=int(time.time()))
+            event = Event.objects.get(organisation=org)
+            for name, render in (("parsed", self.render_parsed), ("stored", self.render_stored)):
+                render(event)
+                timings = []
+                for _ in range(options["iterations"]):
+                    start = time.perf_counter()
+                    render(event)
+                    timings.append((time.perf_counter() - start) * 1000)
+                self.stdout.write(f"{name}: median {statistics.median(timings):.1f}ms per page of cards")
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def render_parsed(event):
+        """The cards as rendered before the display strings were stored"""
+        orders = list(Order.objects.filter(event=event).select_related("event__organisation").prefetch_related(
+            "serving_set"))
+        for order in orders:
+            order.prefetched_servings = list(order.serving_set.all())
+            order.purchaser_whatsapp_display = str(order.purchaser_whatsapp)
+            for serving in order.prefetched_servings:
+                serving.buyer_whatsapp_display = str(serving.buyer_whatsapp)
+        return [render_to_string("events/order_card.html", {"order": order, "event": event}) for order in orders]
+
+    @staticmethod
+    def render_stored(event):
+        orders = list(Order.objects.filter(event=event).with_claim_stats())
+        return [render_to_string("events/order_card.html", {"order": order, "event": event}) for order in orders]
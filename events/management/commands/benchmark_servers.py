@@ -0,0 +1,111 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+import requests
+
+from events.benchmarks import default_scenarios, percentile
+
+
+class Command(BaseCommand):
+    help = ("Starts gunicorn in each SERVER_MODE (see gunicorn.conf.py) and loads the anonymous pages of the busiest "
+            "organisation and event with concurrent clients, comparing WSGI and ASGI throughput and latency.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--modes", nargs="+", default=["wsgi", "asgi"], choices=["wsgi", "asgi"])
+        parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients.")
+        parser.add_argument("--duration", type=float, default=20, help="Seconds of load per mode.")
+        parser.add_argument("--workers", type=int, help="Worker processes (WEB_CONCURRENCY), defaults per mode.")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--host", default="localhost", help="Host header sent, must be in ALLOWED_HOSTS.")
+        parser.add_argument("--output", default="server-benchmark.json", help="File the results are written to.")
+
+    def handle(self, *args, **options):
+        paths = [scenario.url for scenario in default_scenarios() if scenario.user is None]
+        if not paths:
+            raise CommandError("Nothing to benchmark, seed some data first with seed_benchmark_data.")
+        results = {}
+        for mode in options["modes"]:
+            with self.server(mode, options):
+                results[mode] = self.load(paths, options)
+            result = results[mode]
+            self.stdout.write(f"{mode}: {result['requests_per_second']} req/s, p50 {result['p50_ms']}ms, "
+                              f"p95 {result['p95_ms']}ms, {result['errors']} errors")
+        document = {"created_at": timezone.now().isoformat(), "concurrency": options["concurrency"],
+                    "paths": paths, "results": results}
+        Path(options["output"]).write_text(json.dumps(document, indent=2))
+        self.stdout.write(f"Results written to {options['output']}")
+
+    def server(self, mode, options):
+        env = {**os.environ, "SERVER_MODE": mode, "GUNICORN_BIND": f"127.0.0.1:{options['port']}"}
+        if options["workers"]:
+            env["WEB_CONCURRENCY"] = str(options["workers"])
+        process = subprocess.Popen([sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py"],
+                                   cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL)
+        return _Server(process, f"http://127.0.0.1:{options['port']}", options["host"])
+
+    def load(self, paths, options):
+        base_url = f"http://127.0.0.1:{options['port']}"
+        deadline = time.monotonic() + options["duration"]
+
+        def client(offset):
+            timings, errors = [], 0
+            with requests.Session() as session:
+                i = offset
+                while time.monotonic() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        response = session.get(base_url + paths[i % len(paths)], headers={"Host": options["host"]},
+                                               timeout=30)
+                        ok = response.status_code == 200
+                    except requests.RequestException:
+                        ok = False
+                    timings.append((time.perf_counter() - start) * 1000)
+                    errors += not ok
+                    i += 1
+            return timings, errors
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(options["concurrency"]) as pool:
+            outcomes = list(pool.map(client, range(options["concurrency"])))
+        elapsed = time.monotonic() - started
+        timings = [timing for client_timings, _ in outcomes for timing in client_timings]
+        return {
+            "requests": len(timings),
+            "errors": sum(errors for _, errors in outcomes),
+            "requests_per_second": round(len(timings) / elapsed, 1),
+            "p50_ms": round(percentile(timings, 50), 3),
+            "p95_ms": round(percentile(timings, 95), 3),
+        }
+
+
+class _Server:
+    """Context manager waiting for a gunicorn process to answer, and stopping it on exit"""
+
+    def __init__(self, process, base_url, host):
+        self.process = process
+        self.base_url = base_url
+        self.host = host
+
+    def __enter__(self):
+        for _ in range(100):
+            if self.process.poll() is not None:
+                raise CommandError(f"gunicorn exited with status {self.process.returncode}")
+            try:
+                requests.get(self.base_url + "/", headers={"Host": self.host}, timeout=1)
+                return self
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.process.terminate()
+        raise CommandError("gunicorn did not start within 20 seconds")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait(timeout=30)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from events.models import Order, order_changed
+
+
+class Command(BaseCommand):
+    help = "Checks Order.claimed_servings against the linked servings and repairs any drift, in batches of orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Number of orders checked per transaction.")
+        parser.add_argument("--dry-run", action="store_true", help="Report drift without repairing it.")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        dry_run = options["dry_run"]
+        checked = repaired = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    Order.objects.filter(pk__gt=last_id).order_by("pk").annotate(
+                        actual=Coalesce(Sum("serving__number_of_servings"), 0, output_field=models.IntegerField())
+                    ).values_list("pk", "claimed_servings", "actual")[:batch_size]
+                )
+                if not batch:
+                    break
+                for pk, stored, actual in batch:
+                    if stored == actual:
+                        continue
+                    self.stdout.write(f"Order {pk}: claimed_servings={stored}, servings total={actual}")
+                    if not dry_run:
+                        # Lock the row and recount so a concurrent claim between the two reads isn't overwritten
+                        order = Order.objects.select_for_update().get(pk=pk)
+                        Order.objects.filter(pk=pk).update(claimed_servings=order.count_claimed_servings(),
+                                                           **order_changed())
+                    repaired += 1
+            checked += len(batch)
+            last_id = batch[-1][0]
+        verb = "Found" if dry_run else "Repaired"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} order(s). {verb} {repaired} with drift."))
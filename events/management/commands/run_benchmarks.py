@@ -0,0 +1,57 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from events.benchmarks import compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Times the main pages through the test client against the current database (see seed_benchmark_data), "
+            "writes p50/p95 latency and query counts to a JSON file and compares them with a baseline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Timed requests per page.")
+        parser.add_argument("--warmup", type=int, default=5, help="Untimed requests per page before timing.")
+        parser.add_argument("--output", default="benchmark-results.json", help="File the results are written to.")
+        parser.add_argument("--baseline", help="Results file from an earlier run to compare against.")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed p95 slowdown against the baseline, as a fraction.")
+        parser.add_argument("--update-baseline", action="store_true",
+                            help="Overwrite the baseline with this run's results instead of comparing.")
+
+    def handle(self, *args, **options):
+        # The test client sends Host: testserver
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+            try:
+                results = run_benchmarks(iterations=options["iterations"], warmup=options["warmup"])
+            except RuntimeError as e:
+                raise CommandError(e)
+        if not results:
+            raise CommandError("Nothing to benchmark, seed some data first with seed_benchmark_data.")
+
+        for name, result in results.items():
+            self.stdout.write(f"{name}: p50 {result['p50_ms']}ms, p95 {result['p95_ms']}ms, "
+                              f"{result['queries']} queries")
+        document = {"created_at": timezone.now().isoformat(), "results": results}
+        Path(options["output"]).write_text(json.dumps(document, indent=2))
+        self.stdout.write(f"Results written to {options['output']}")
+
+        baseline_path = options["baseline"]
+        if baseline_path is None:
+            return
+        if options["update_baseline"]:
+            Path(baseline_path).write_text(json.dumps(document, indent=2))
+            self.stdout.write(f"Baseline {baseline_path} updated")
+            return
+        try:
+            baseline = json.loads(Path(baseline_path).read_text())["results"]
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Could not read baseline {baseline_path}: {e}")
+        regressions = compare(results, baseline, options["tolerance"])
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline_path}"))
@@ -0,0 +1,52 @@
+import logging
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from events.tasks import run_next_task
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of worker threads that process queued background tasks (emails, Stripe calls)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.TASK_WORKERS, help="Number of worker threads.")
+        parser.add_argument("--poll-interval", type=float, default=settings.TASK_POLL_INTERVAL,
+                            help="Seconds an idle worker waits before checking for due tasks again.")
+        parser.add_argument("--once", action="store_true", help="Exit once no tasks are due instead of polling.")
+
+    def handle(self, *args, **options):
+        stopping = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda *_: stopping.set())
+
+        def work():
+            try:
+                while not stopping.is_set():
+                    close_old_connections()
+                    try:
+                        ran = run_next_task()
+                    except Exception:
+                        # e.g. the database went away; back off and keep the worker alive
+                        logger.exception("Task worker failed to claim a task")
+                        ran = False
+                    if not ran:
+                        if options["once"]:
+                            return
+                        stopping.wait(options["poll_interval"])
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=work, name=f"task-worker-{i}") for i in range(options["workers"])]
+        self.stdout.write(f"Starting {len(workers)} task worker(s)")
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.stdout.write("Task workers stopped")
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from events.models import Event, Order, Serving
+from events.testing_utils import SEED_DISTRIBUTIONS, bulk_seed
+
+
+class Command(BaseCommand):
+    help = "Bulk creates a synthetic dataset of organisations, events, orders and servings for benchmarking."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--organisations", type=int, default=50, help="Number of organisations to create.")
+        parser.add_argument("--events-per-org", type=int, default=40, help="Average number of events per organisation.")
+        parser.add_argument("--orders-per-event", type=int, default=10, help="Average number of orders per event.")
+        parser.add_argument("--servings-per-order", type=int, default=4,
+                            help="Average number of servings claimed from each order.")
+        parser.add_argument("--distribution", choices=SEED_DISTRIBUTIONS, default="uniform",
+                            help="'uniform' gives every organisation, event and order the same size, 'skewed' gives "
+                                 "a long tail of very busy ones.")
+        parser.add_argument("--private-ratio", type=float, default=0.3, help="Fraction of events that are private.")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Random seed, also used in organisation names so several datasets can coexist.")
+
+    def handle(self, *args, **options):
+        orgs = bulk_seed(
+            organisations=options["organisations"],
+            events_per_org=options["events_per_org"],
+            orders_per_event=options["orders_per_event"],
+            servings_per_order=options["servings_per_order"],
+            seed=options["seed"],
+            distribution=options["distribution"],
+            private_ratio=options["private_ratio"],
+        )
+        events = Event.objects.filter(organisation__in=orgs)
+        orders = Order.objects.filter(event__in=events)
+        servings = Serving.objects.filter(order__in=orders)
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(orgs)} organisation(s), {events.count()} event(s), {orders.count()} order(s) and "
+            f"{servings.count()} serving(s)."))
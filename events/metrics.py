@@ -0,0 +1,117 @@
+"""
+Prometheus metrics for requests (per resolved view name), database queries, Stripe calls and email sends, served at
+/metrics. Under gunicorn set PROMETHEUS_MULTIPROC_DIR (see entrypoint.sh) so every worker process, and the task
+workers, write to a shared directory that the endpoint aggregates.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess)
+
+from .instrumentation import aobserve_queries, observe_queries, observe_stripe
+
+REQUESTS = Counter("pizzapool_http_requests_total", "Requests by view, method and status.",
+                   ["view", "method", "status"])
+REQUEST_LATENCY = Histogram("pizzapool_http_request_duration_seconds", "Request latency by view.", ["view"])
+DB_QUERIES = Histogram("pizzapool_db_queries_per_request", "Database queries per request by view.", ["view"],
+                       buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+DB_TIME = Histogram("pizzapool_db_time_per_request_seconds", "Time spent in database queries per request by view.",
+                    ["view"])
+STRIPE_LATENCY = Histogram("pizzapool_stripe_request_duration_seconds", "Stripe API request latency.")
+STRIPE_ERRORS = Counter("pizzapool_stripe_errors_total", "Failed Stripe API requests, by HTTP status or exception.",
+                        ["reason"])
+EMAIL_LATENCY = Histogram("pizzapool_email_send_duration_seconds", "Time to send a batch of emails.")
+EMAIL_ERRORS = Counter("pizzapool_email_errors_total", "Failed email sends.")
+# Request methods get their own label value, anything else a client sends is counted as "other"
+HTTP_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+class QueryTimer:
+    """Query observer counting queries and the time spent in them"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, sql, duration):
+        self.count += 1
+        self.duration += duration
+
+
+class MetricsMiddleware:
+    """Records request count, latency and database usage per resolved view name, e.g. events:event-detail"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryTimer()
+        start = time.perf_counter()
+        with observe_queries(queries):
+            response = self.get_response(request)
+        return self.record(request, response, queries, start)
+
+    async def __acall__(self, request):
+        queries = QueryTimer()
+        start = time.perf_counter()
+        async with aobserve_queries(queries):
+            response = await self.get_response(request)
+        return self.record(request, response, queries, start)
+
+    def record(self, request, response, queries, start):
+        duration = time.perf_counter() - start
+        view = request.resolver_match.view_name if request.resolver_match else "<unresolved>"
+        method = request.method if request.method in HTTP_METHODS else "other"
+        REQUESTS.labels(view, method, response.status_code).inc()
+        REQUEST_LATENCY.labels(view).observe(duration)
+        DB_QUERIES.labels(view).observe(queries.count)
+        DB_TIME.labels(view).observe(queries.duration)
+        return response
+
+
+def record_stripe_request(duration, status, error):
+    """Stripe observer recording the latency of each request and counting failed ones"""
+    STRIPE_LATENCY.observe(duration)
+    if error is not None:
+        STRIPE_ERRORS.labels(type(error).__name__).inc()
+    elif status >= 400:
+        STRIPE_ERRORS.labels(str(status)).inc()
+
+
+def instrument_stripe():
+    observe_stripe(record_stripe_request)
+
+
+@contextmanager
+def observe_email_send():
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EMAIL_ERRORS.inc()
+        raise
+    finally:
+        EMAIL_LATENCY.observe(time.perf_counter() - start)
+
+
+def render_latest():
+    """The current metrics in the Prometheus text format, aggregated over all processes in multiprocess mode"""
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
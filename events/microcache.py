@@ -0,0 +1,77 @@
+"""
+Anonymous full-page microcache.
+
+Public organisation and event pages served to anonymous visitors carry an X-Accel-Expires header, so nginx keeps
+them for MICROCACHE_SECONDS (see nginx/nginx.conf), and a Surrogate-Key header naming the organisation and event
+they show. After a write to an event, order or serving the affected pages are refreshed in nginx by a background
+task that requests them with MICROCACHE_REFRESH_SECRET in the X-Microcache-Refresh header, which makes nginx bypass
+and replace its copy.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.urls import reverse
+import requests
+
+from .models import Event
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+
+def org_key(path):
+    return f"org-{path}"
+
+
+def event_key(slug):
+    return f"event-{slug}"
+
+
+class MicrocacheMixin:
+    """Marks an async view's GET responses to anonymous visitors as cacheable by nginx under get_surrogate_keys()"""
+
+    def get_surrogate_keys(self):
+        raise NotImplementedError
+
+    async def get(self, request, *args, **kwargs):
+        response = await super().get(request, *args, **kwargs)
+        user = await request.auser()
+        if (settings.MICROCACHE_SECONDS and not user.is_authenticated and response.status_code == 200
+                and not response.cookies):
+            response["X-Accel-Expires"] = settings.MICROCACHE_SECONDS
+            response["Surrogate-Key"] = " ".join(self.get_surrogate_keys())
+        return response
+
+
+@task(max_attempts=3)
+def refresh_pages(event_id=None, organisation_path=None):
+    """Re-fetches an event's page and/or an organisation's page through nginx"""
+    paths = []
+    if event_id is not None:
+        event = Event.objects.filter(pk=event_id).select_related('organisation').first()
+        if event is not None:
+            paths.append(reverse("events:event-detail", args=[event.organisation.path, event.slug]))
+    if organisation_path is not None:
+        paths.append(reverse("events:org-detail", args=[organisation_path]))
+    headers = {"X-Microcache-Refresh": settings.MICROCACHE_REFRESH_SECRET}
+    if settings.MICROCACHE_PURGE_HOST:
+        headers["Host"] = settings.MICROCACHE_PURGE_HOST
+    for path in paths:
+        requests.get(settings.MICROCACHE_PURGE_URL + path, headers=headers, timeout=10).raise_for_status()
+
+
+def refresh_on_commit(event_id=None, organisation_path=None):
+    """
+    Queues refresh_pages once the current transaction commits. Refreshes of the same pages are coalesced to one a
+    second, as the task reads the latest data when it runs and nginx only keeps pages for MICROCACHE_SECONDS anyway.
+    """
+    if not settings.MICROCACHE_PURGE_URL or not settings.MICROCACHE_REFRESH_SECRET:
+        return
+
+    def queue():
+        if cache.add(f"microcache-refresh:{event_id}:{organisation_path}", True, 1):
+            refresh_pages.enqueue(event_id=event_id, organisation_path=organisation_path)
+
+    transaction.on_commit(queue)
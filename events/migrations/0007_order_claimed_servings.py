@@ -0,0 +1,29 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:16
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_claimed_servings(apps, schema_editor):
+    Order = apps.get_model('events', 'Order')
+    Serving = apps.get_model('events', 'Serving')
+    totals = Serving.objects.filter(order=OuterRef('pk')).values('order').annotate(
+        total=Sum('number_of_servings')).values('total')
+    Order.objects.update(claimed_servings=Coalesce(Subquery(totals), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0006_remove_serving_is_locked_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='claimed_servings',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_claimed_servings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:21
+
+from django.db import migrations, models
+
+
+def mark_existing_accounts_provisioned(apps, schema_editor):
+    Organisation = apps.get_model('events', 'Organisation')
+    Organisation.objects.exclude(stripe_account_id='').update(stripe_provisioning_status='provisioned')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0007_order_claimed_servings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organisation',
+            name='stripe_provisioning_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('provisioned', 'Provisioned'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+        migrations.RunPython(mark_existing_accounts_provisioned, migrations.RunPython.noop),
+    ]
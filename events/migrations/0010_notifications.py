@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0009_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.EmailField(max_length=254)),
+                ('subject', models.CharField(max_length=200)),
+                ('message', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='purchaser_email',
+            field=models.EmailField(blank=True, max_length=254, verbose_name='Email (Optional, for order updates)'),
+        ),
+        migrations.AddField(
+            model_name='serving',
+            name='buyer_email',
+            field=models.EmailField(blank=True, max_length=254, verbose_name='Email (Optional, for order updates)'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0010_notifications'),
+    ]
+
+    operations = [
+        # Create the composite indexes before dropping the single-column FK indexes they replace
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['organisation', 'private', 'date'], name='event_org_private_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['organisation', 'date'], name='event_org_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['event', 'id'], name='order_event_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='serving',
+            index=models.Index(fields=['order', 'id'], name='serving_order_id_idx'),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='organisation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='events.organisation'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='event',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='events.event'),
+        ),
+        migrations.AlterField(
+            model_name='serving',
+            name='order',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='events.order'),
+        ),
+    ]
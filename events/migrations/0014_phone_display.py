@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-17 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0013_order_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='purchaser_whatsapp_display',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='serving',
+            name='buyer_whatsapp_display',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-17 19:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0014_phone_display'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.CharField(max_length=32, unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('date', models.DateTimeField()),
+                ('description', models.CharField(blank=True, max_length=200)),
+                ('private', models.BooleanField()),
+                ('locked', models.BooleanField()),
+                ('servings_per_order', models.PositiveIntegerField()),
+                ('orders', models.JSONField(default=list)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('organisation', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE,
+                                                   to='events.organisation')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['organisation', 'private', 'date'],
+                                         name='archive_org_private_date_idx')],
+            },
+        ),
+    ]
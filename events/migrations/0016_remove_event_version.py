@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-17 18:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0015_eventarchive'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='event',
+            name='version',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0016_remove_event_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organisation',
+            name='stripe_provisioning_key_generation',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
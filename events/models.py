@@ -1,12 +1,14 @@
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Sum, UniqueConstraint
-from django.db.models.functions import Lower
+from django.db import connection, models, router, transaction
+from django.db.models import F, Prefetch, Sum, UniqueConstraint
+from django.db.models.functions import Coalesce, Lower
+from django.db.models.signals import post_delete, pre_delete
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
 from django.template.defaultfilters import slugify
 from django.utils import timezone
 from django.conf import settings
+from typing import NamedTuple, Optional
 from django_sqids import SqidsField
 from phonenumber_field.modelfields import PhoneNumberField
 import stripe
@@ -18,6 +20,12 @@ alphanumeric_hyphen_space = RegexValidator(
     'Only alphanumeric characters, hyphens and spaces are allowed.')
 
 
+class StripeProvisioning(models.TextChoices):
+    PENDING = "pending", "Pending"
+    PROVISIONED = "provisioned", "Provisioned"
+    FAILED = "failed", "Failed"
+
+
 class Organisation(models.Model):
     name = models.CharField(max_length=50, unique=True, validators=[alphanumeric_hyphen_space])
     description = models.CharField(max_length=200)
@@ -25,6 +33,13 @@ class Organisation(models.Model):
     path = models.SlugField(unique=True)
     stripe_account_id = models.CharField(max_length=255, blank=True)
     stripe_account_verified = models.BooleanField(default=False)
+    stripe_provisioning_status = models.CharField(max_length=20, choices=StripeProvisioning.choices,
+                                                  default=StripeProvisioning.PENDING)
+    # Advanced when Stripe replays a stored error for the account creation's idempotency key, see events.payments
+    stripe_provisioning_key_generation = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped by touch_organisation() whenever one of its events is written, see ConditionalGetMixin
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         constraints = [
@@ -55,8 +70,18 @@ class OrgUser(AbstractUser):
         return f"{'[ADMIN] ' if self.is_superuser else ''}{self.username}"
 
 
+class EventQuerySet(models.QuerySet):
+    def listed(self, organisation, include_private=False):
+        """Events shown on an organisation's page, private events only for the organisation's own users"""
+        events = self.filter(organisation=organisation)
+        if not include_private:
+            events = events.filter(private=False)
+        return events
+
+
 class Event(models.Model):
-    organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE)
+    # Indexed by the composite indexes in Meta, which start with organisation
+    organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE, db_index=False)
     slug = SqidsField(real_field_name="id", min_length=10, unique=True)
     name = models.CharField(max_length=100)
     date = models.DateTimeField("date of event")
@@ -65,10 +90,26 @@ class Event(models.Model):
                                                      validators=[MinValueValidator(1)])
     private = models.BooleanField(default=True)
     locked = models.BooleanField(default=False)
+    # Only the event's own writes: claims change the order rows, which the page's validators also read, see
+    # EventDetailView.get_validators()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Organisation page: public events either side of today, and all events for the org's own users
+            models.Index(fields=['organisation', 'private', 'date'], name='event_org_private_date_idx'),
+            models.Index(fields=['organisation', 'date'], name='event_org_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.organisation} - {self.date}: {'[LOCKED]' if self.locked else ''} {self.name}"
 
+    def delete(self, using=None, keep_parents=False):
+        return cascade_delete(self, Event.objects.filter(pk=self.pk), [
+            Serving.objects.filter(order__event_id=self.pk), Order.objects.filter(event_id=self.pk)], using)
+
     def upcoming(self, organisation):
         return self.filter(organisation=organisation, start__gte=timezone.now().replace(hour=0, minute=0, second=0),
                            end__lte=timezone.now().replace(hour=23, minute=59, second=59))
@@ -77,15 +118,55 @@ class Event(models.Model):
         return self.filter(organisation=organisation, date__lt=timezone.now())
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_claim_stats(self, servings=True):
+        """
+        Annotates total_claimed and total_remaining, joins the event and organisation and prefetches the linked
+        servings into prefetched_servings, so a list of orders renders in a fixed number of queries. With
+        servings=False the servings are left for the caller to prefetch, see servings_prefetch(). Phone numbers are
+        left out, the stored display strings are shown instead.
+        """
+        orders = self.select_related('event__organisation').defer('purchaser_whatsapp').annotate(
+            total_claimed=F('claimed_servings'),
+            total_remaining=F('available_servings') - F('claimed_servings'),
+        ).order_by('id')
+        if servings:
+            orders = orders.prefetch_related(servings_prefetch())
+        return orders
+
+
+def servings_prefetch():
+    """Prefetches an order's servings into prefetched_servings, in the order they were claimed"""
+    return Prefetch('serving_set', queryset=Serving.objects.defer('buyer_whatsapp').order_by('id'),
+                    to_attr='prefetched_servings')
+
+
+def format_phone(number):
+    """A phone number as displayed (PHONENUMBER_DEFAULT_FORMAT), stored when saved so pages don't parse it per row"""
+    return str(number) if number else ""
+
+
 class Order(models.Model):
-    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, db_index=False)  # see Meta.indexes
     purchaser_name = models.CharField("Your Name", max_length=50)
     purchaser_whatsapp = PhoneNumberField("WhatsApp", null=False, blank=False)
+    purchaser_whatsapp_display = models.CharField(max_length=32, blank=True, editable=False)
     purchaser_revolut = models.CharField("Revolut username", max_length=16, validators=[alphanumeric])
+    purchaser_email = models.EmailField("Email (Optional, for order updates)", blank=True)
     description = models.CharField("Food description (e.g. Pizza type)", max_length=100)
     price_per_serving = models.DecimalField(max_digits=4, decimal_places=2)
     available_servings = models.PositiveIntegerField("Servings available to be claimed by other users",
                                                      default=1, validators=[MinValueValidator(1)])
+    # Denormalised SUM(serving.number_of_servings), maintained by Serving.save() and the Serving post_delete signal
+    claimed_servings = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped with claimed_servings, and updated_at on every write, so the pair keys the cached order card
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['event', 'id'], name='order_event_id_idx')]
 
     def __str__(self) -> str:
         return f"{self.purchaser_name} - {self.description}"
@@ -96,11 +177,12 @@ class Order(models.Model):
 
     def get_total_claimed(self) -> int:
         """Returns the number of slices linked with this order"""
-        matched_servings = self.matched_servings()
-        if matched_servings:
-            return matched_servings.aggregate(Sum('number_of_servings'))['number_of_servings__sum']
-        else:
-            return 0
+        return self.claimed_servings
+
+    def count_claimed_servings(self) -> int:
+        """Returns the number of slices linked with this order, summed from the Serving table"""
+        return self.matched_servings().aggregate(
+            total=Coalesce(Sum('number_of_servings'), 0, output_field=models.IntegerField()))['total']
 
     def get_total_remaining(self):
         """Returns the number of servings that have not been claimed from the order"""
@@ -122,23 +204,221 @@ class Order(models.Model):
     def save(self, *args, **kwargs):
         self._validate_available_servings_maximum()
         self._validate_event_is_unlocked()
+        self.purchaser_whatsapp_display = format_phone(self.purchaser_whatsapp)
         super(Order, self).save(*args, **kwargs)
 
+    def delete(self, using=None, keep_parents=False):
+        return cascade_delete(self, Event.objects.filter(pk=self.event_id), [Serving.objects.filter(order_id=self.pk)],
+                              using)
+
 
 class Serving(models.Model):
-    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, db_index=False)  # see Meta.indexes
     buyer_name = models.CharField("Name", max_length=50)
     buyer_whatsapp = PhoneNumberField("WhatsApp", null=False, blank=False)
+    buyer_whatsapp_display = models.CharField(max_length=32, blank=True, editable=False)
+    buyer_email = models.EmailField("Email (Optional, for order updates)", blank=True)
     number_of_servings = models.PositiveIntegerField(default=1, validators=[
         MinValueValidator(1)])
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['order', 'id'], name='serving_order_id_idx')]
 
     def __str__(self) -> str:
         return f"{self.buyer_name}"
 
     def save(self, *args, **kwargs):
-        if self.id is None:
-            if self.order.event_is_locked():
-                raise ValidationError("Event is locked", code="locked")
-            if self.number_of_servings > self.order.get_total_remaining():
-                raise ValidationError("Insufficient remaining servings", code="insufficient_servings")
-        super(Serving, self).save(*args, **kwargs)
+        self.buyer_whatsapp_display = format_phone(self.buyer_whatsapp)
+        with transaction.atomic():
+            if self.id is None:
+                if self.order.event_is_locked():
+                    raise ValidationError("Event is locked", code="locked")
+                status = reserve_servings(self.order, self.number_of_servings)
+                if status == ClaimStatus.LOCKED:
+                    raise ValidationError("Event is locked", code="locked")
+                if status == ClaimStatus.INSUFFICIENT:
+                    raise ValidationError("Insufficient remaining servings", code="insufficient_servings")
+            else:
+                self._move_servings()
+            super(Serving, self).save(*args, **kwargs)
+
+    def _move_servings(self):
+        """Applies an edit of number_of_servings (or of the order) to the claimed counters"""
+        previous = Serving.objects.filter(pk=self.pk).values('order_id', 'number_of_servings').first()
+        if previous is None:
+            return
+        release_servings(previous['order_id'], previous['number_of_servings'])
+        Order.objects.filter(pk=self.order_id).update(
+            claimed_servings=F('claimed_servings') + self.number_of_servings, **order_changed())
+        if not Serving.order.is_cached(self):
+            return
+        if previous['order_id'] == self.order_id:
+            self.order.claimed_servings += self.number_of_servings - previous['number_of_servings']
+        else:
+            self.order.claimed_servings += self.number_of_servings
+
+
+def order_changed():
+    """update() kwargs marking an order row as changed, for the queryset updates that bypass auto_now"""
+    return {'version': F('version') + 1, 'updated_at': timezone.now()}
+
+
+def touch_organisation(organisation_id):
+    """Marks an organisation's page as changed after a write to one of its events"""
+    Organisation.objects.filter(pk=organisation_id).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def cascade_delete(instance, lock, children, using=None):
+    """
+    Deletes instance after the children querysets (innermost first) with one DELETE statement each, instead of the
+    collector loading every row and sending its signals, so memory and time don't grow with the number of rows. Only
+    instance's own pre_delete and post_delete are sent: the order and serving receivers ignore deletes cascaded from
+    a parent. The lock queryset's rows (the event) are locked first, which waits for claims in progress, as they hold
+    a share lock on the event, and keeps new ones out until the delete commits.
+    """
+    model = type(instance)
+    if instance.pk is None:
+        raise ValueError(f"{model._meta.object_name} object can't be deleted because its id attribute is set to None.")
+    using = using or router.db_for_write(model, instance=instance)
+    deleted = {}
+    with transaction.atomic(using=using):
+        list(lock.using(using).select_for_update().values_list('pk', flat=True))
+        pre_delete.send(model, instance=instance, using=using, origin=instance)
+        for queryset in [*children, model.objects.filter(pk=instance.pk)]:
+            # The same set-based delete the collector uses for models without delete signals
+            deleted[queryset.model._meta.label] = queryset.using(using)._raw_delete(using)
+        post_delete.send(model, instance=instance, using=using, origin=instance)
+    instance.pk = None
+    return sum(deleted.values()), deleted
+
+
+def release_servings(order_id, number_of_servings):
+    """Subtracts number_of_servings from an order's claimed counter without letting it go negative"""
+    return Order.objects.filter(pk=order_id, claimed_servings__gte=number_of_servings).update(
+        claimed_servings=F('claimed_servings') - number_of_servings, **order_changed())
+
+
+class ClaimStatus(models.TextChoices):
+    CLAIMED = "claimed"
+    INSUFFICIENT = "insufficient"
+    LOCKED = "locked"
+
+
+class ClaimResult(NamedTuple):
+    status: ClaimStatus
+    serving: Optional["Serving"] = None
+
+    @property
+    def claimed(self) -> bool:
+        return self.status == ClaimStatus.CLAIMED
+
+
+def _event_is_locked_for_claim(event_id) -> bool:
+    """
+    Reads Event.locked holding a FOR SHARE row lock until the end of the transaction. Claims don't block each other,
+    but locking the event waits for in-flight claims, and claims started after the lock commits see it.
+    """
+    if not connection.features.has_select_for_update:
+        return Event.objects.filter(pk=event_id, locked=True).exists()
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT locked FROM {Event._meta.db_table} WHERE id = %s FOR SHARE", [event_id])
+        row = cursor.fetchone()
+    return row is None or row[0]
+
+
+def reserve_servings(order, number_of_servings) -> ClaimStatus:
+    """
+    Adds number_of_servings to the order's claimed counter with a single conditional UPDATE, only if the event is
+    unlocked and the order has enough remaining. Must be called inside transaction.atomic().
+    """
+    if _event_is_locked_for_claim(order.event_id):
+        return ClaimStatus.LOCKED
+    updated = Order.objects.filter(
+        pk=order.pk,
+        claimed_servings__lte=F('available_servings') - number_of_servings,
+    ).update(claimed_servings=F('claimed_servings') + number_of_servings, **order_changed())
+    if not updated:
+        return ClaimStatus.INSUFFICIENT
+    order.claimed_servings += number_of_servings
+    return ClaimStatus.CLAIMED
+
+
+def claim_servings(order, buyer_name, buyer_whatsapp, number_of_servings=1, buyer_email="") -> ClaimResult:
+    """Claims servings from an order, returning the outcome instead of raising for locked or full orders"""
+    serving = Serving(order=order, buyer_name=buyer_name, buyer_whatsapp=buyer_whatsapp, buyer_email=buyer_email,
+                      number_of_servings=number_of_servings)
+    try:
+        serving.save()
+    except ValidationError as e:
+        if e.code == "locked":
+            return ClaimResult(ClaimStatus.LOCKED)
+        if e.code == "insufficient_servings":
+            return ClaimResult(ClaimStatus.INSUFFICIENT)
+        raise
+    return ClaimResult(ClaimStatus.CLAIMED, serving)
+
+
+class EventArchive(models.Model):
+    """
+    A past event moved out of the Event, Order and Serving tables by the archive_events command (see events.archive):
+    the event's details and a summary of each order, without anyone's contact details. Read only, and served at the
+    event's original URL.
+    """
+    organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE, db_index=False)  # see Meta.indexes
+    # The archived event's slug, which keeps encoding its old id
+    slug = models.CharField(max_length=32, unique=True)
+    name = models.CharField(max_length=100)
+    date = models.DateTimeField()
+    description = models.CharField(max_length=200, blank=True)
+    private = models.BooleanField()
+    locked = models.BooleanField()
+    servings_per_order = models.PositiveIntegerField()
+    # [{purchaser_name, description, price_per_serving, available_servings, claimed_servings, buyers}] by order id
+    orders = models.JSONField(default=list)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['organisation', 'private', 'date'], name='archive_org_private_date_idx')]
+
+    def __str__(self):
+        return f"{self.organisation_id} - {self.date}: {self.name} [ARCHIVED]"
+
+
+class TaskStatus(models.TextChoices):
+    QUEUED = "queued", "Queued"
+    RUNNING = "running", "Running"
+    DEAD = "dead", "Dead"
+
+
+class Task(models.Model):
+    """A background job run by the run_workers command, see events.tasks. Finished tasks are deleted."""
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=TaskStatus.choices, default=TaskStatus.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx')]
+
+    def __str__(self):
+        return f"{self.name} [{self.status}]"
+
+
+class Notification(models.Model):
+    """An email waiting to be coalesced with others for the same recipient, see events.notifications"""
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=200)
+    message = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.recipient}: {self.subject}"
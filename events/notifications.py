@@ -0,0 +1,91 @@
+"""
+Email notifications for purchasers and claimants.
+
+Notifications are stored rather than sent straight away. One send_notifications task per NOTIFICATION_WINDOW seconds
+combines everything pending for each recipient into a single email and sends the whole batch over one SMTP
+connection, so a burst of claims costs a handful of SMTP sessions rather than one per claim.
+"""
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import observe_email_send
+from .models import Notification, Serving, Task, TaskStatus
+from .tasks import task
+
+
+def notify(recipients, subject, message):
+    """Queues a notification for each recipient with an email address"""
+    recipients = {recipient for recipient in recipients if recipient}
+    if not recipients:
+        return
+    Notification.objects.bulk_create(
+        Notification(recipient=recipient, subject=subject, message=message) for recipient in sorted(recipients))
+    if not Task.objects.filter(name=send_notifications.task_name, status=TaskStatus.QUEUED).exists():
+        send_notifications.enqueue(run_at=timezone.now() + timedelta(seconds=settings.NOTIFICATION_WINDOW))
+
+
+def _claimant_emails(order):
+    return Serving.objects.filter(order=order).exclude(buyer_email="").values_list('buyer_email', flat=True)
+
+
+def order_full(order):
+    notify([order.purchaser_email, *_claimant_emails(order)], f"Order full: {order}",
+           f"All {order.available_servings} available servings of {order.purchaser_name}'s order "
+           f"({order.description}) for {order.event.name} have been claimed. "
+           f"Payments go to Revolut user {order.purchaser_revolut}.")
+
+
+def event_locked(event):
+    orders = event.order_set.all()
+    buyers = Serving.objects.filter(order__event=event).exclude(buyer_email="").values_list('buyer_email', flat=True)
+    notify([*orders.exclude(purchaser_email="").values_list('purchaser_email', flat=True), *buyers],
+           f"Event locked: {event.name}",
+           f"{event.name} has been locked by the organiser, orders and claims can no longer be changed.")
+
+
+def serving_cancelled(serving, order):
+    notify([serving.buyer_email, order.purchaser_email], f"Claim cancelled: {order}",
+           f"{serving.buyer_name}'s claim of {serving.number_of_servings} serving(s) from {order.purchaser_name}'s "
+           f"order ({order.description}) has been cancelled.")
+
+
+def build_digest(recipient, notifications) -> EmailMessage:
+    """Combines a recipient's pending notifications into one email"""
+    # The same update can be raised twice (e.g. an event locked, unlocked and locked again), only send it once
+    updates = list(dict.fromkeys((n.subject, n.message) for n in notifications))
+    subject = updates[0][0] if len(updates) == 1 else f"{len(updates)} pizzapool updates"
+    body = "\n\n".join(f"{update_subject}\n{message}" for update_subject, message in updates)
+    return EmailMessage(f"[pizzapool] {subject}", body, to=[recipient])
+
+
+@task(max_attempts=5)
+def send_notifications():
+    """
+    Sends every pending notification, one email per recipient, through a single email connection. The batch is taken
+    off the table in a short transaction before sending; if sending fails the unsent digests' notifications are put
+    back and the task is retried, so digests already sent aren't sent again.
+    """
+    with transaction.atomic():
+        pending = list(Notification.objects.select_for_update(skip_locked=True).order_by('recipient', 'created_at')
+                       [:settings.NOTIFICATION_BATCH_SIZE])
+        Notification.objects.filter(pk__in=[n.pk for n in pending]).delete()
+    if not pending:
+        return
+    digests = [list(notifications) for _, notifications in groupby(pending, key=lambda n: n.recipient)]
+    sent = 0
+    try:
+        with observe_email_send(), get_connection(settings.TASK_EMAIL_BACKEND) as connection:
+            for notifications in digests:
+                connection.send_messages([build_digest(notifications[0].recipient, notifications)])
+                sent += 1
+    finally:
+        unsent = [notification for notifications in digests[sent:] for notification in notifications]
+        if unsent:
+            Notification.objects.bulk_create(unsent)
+    if len(pending) == settings.NOTIFICATION_BATCH_SIZE:
+        send_notifications.enqueue()
@@ -0,0 +1,117 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+import stripe
+
+from .auth import forget_organisation_principals
+from .models import Organisation, StripeProvisioning
+from .tasks import task
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+logger = logging.getLogger(__name__)
+
+
+def account_is_verified(account) -> bool:
+    """A Stripe account is verified once both charges and payouts are enabled"""
+    return bool(account["charges_enabled"] and account["payouts_enabled"])
+
+
+def _verification_check_key(stripe_account_id):
+    return f"stripe-verification-checked:{stripe_account_id}"
+
+
+def _clear_verification_check(stripe_account_id):
+    cache.delete(_verification_check_key(stripe_account_id))
+
+
+def set_account_verified(stripe_account_id, verified) -> int:
+    """Stores the verification status for the organisation linked to a Stripe account"""
+    _clear_verification_check(stripe_account_id)
+    organisations = Organisation.objects.filter(stripe_account_id=stripe_account_id)
+    updated = organisations.exclude(stripe_account_verified=verified).update(stripe_account_verified=verified)
+    if updated:
+        forget_organisation_principals(organisations)
+    return updated
+
+
+@task(max_attempts=3, on_dead=_clear_verification_check)
+def refresh_account_verification(stripe_account_id) -> bool:
+    """Fetches the account from Stripe and stores whether it is verified"""
+    verified = account_is_verified(stripe.Account.retrieve(stripe_account_id))
+    set_account_verified(stripe_account_id, verified)
+    return verified
+
+
+def schedule_verification_refresh(organisation) -> bool:
+    """
+    Rechecks an unverified organisation's Stripe account in the background, at most once per
+    STRIPE_VERIFICATION_TTL seconds. The account.updated webhook normally flips the flag first.
+    """
+    if organisation.stripe_account_verified or not organisation.stripe_account_id:
+        return False
+    if not cache.add(_verification_check_key(organisation.stripe_account_id), True,
+                     settings.STRIPE_VERIFICATION_TTL):
+        return False
+    refresh_account_verification.enqueue(organisation.stripe_account_id)
+    return True
+
+
+def handle_webhook_event(event):
+    """Applies a verified Stripe webhook event"""
+    if event["type"] == "account.updated":
+        account = event["data"]["object"]
+        set_account_verified(account["id"], account_is_verified(account))
+
+
+def provisioning_idempotency_key(organisation_id, generation=0):
+    # Retries of the same organisation's account creation return the first account instead of a new one
+    return f"organisation-{organisation_id}-account{f'-{generation}' if generation else ''}"
+
+
+def _is_replayed(error):
+    """Whether a Stripe error is the stored result of an earlier request with the same idempotency key"""
+    return (error.headers or {}).get("Idempotent-Replayed") == "true"
+
+
+def _mark_provisioning_failed(organisation_id):
+    logger.error("Giving up provisioning a Stripe account for organisation %s", organisation_id)
+    Organisation.objects.filter(pk=organisation_id).update(stripe_provisioning_status=StripeProvisioning.FAILED)
+    forget_organisation_principals(Organisation.objects.filter(pk=organisation_id))
+
+
+@task(max_attempts=5, on_dead=_mark_provisioning_failed)
+def provision_stripe_account(organisation_id):
+    """Creates the organisation's Stripe account if it doesn't have one. Failures are retried by the task queue."""
+    organisation = Organisation.objects.get(pk=organisation_id)
+    if organisation.stripe_account_id:
+        Organisation.objects.filter(pk=organisation_id).update(
+            stripe_provisioning_status=StripeProvisioning.PROVISIONED)
+        forget_organisation_principals(Organisation.objects.filter(pk=organisation_id))
+        return organisation.stripe_account_id
+    generation = organisation.stripe_provisioning_key_generation
+    try:
+        account = stripe.Account.create(idempotency_key=provisioning_idempotency_key(organisation_id, generation))
+    except stripe.StripeError as e:
+        # Stripe keeps returning a stored error (e.g. a 500) for its key for 24 hours, so only a new key gets past it.
+        # The new key is saved first, so a retry after this request is lost reuses it rather than making another.
+        if not _is_replayed(e):
+            raise
+        generation += 1
+        Organisation.objects.filter(pk=organisation_id).update(stripe_provisioning_key_generation=generation)
+        account = stripe.Account.create(idempotency_key=provisioning_idempotency_key(organisation_id, generation))
+    Organisation.objects.filter(pk=organisation_id, stripe_account_id="").update(
+        stripe_account_id=account["id"], stripe_provisioning_status=StripeProvisioning.PROVISIONED)
+    forget_organisation_principals(Organisation.objects.filter(pk=organisation_id))
+    return account["id"]
+
+
+def schedule_account_provisioning(organisation) -> bool:
+    """Queues creation of a Stripe account for an organisation without one"""
+    if organisation.stripe_account_id:
+        return False
+    Organisation.objects.filter(pk=organisation.pk).update(stripe_provisioning_status=StripeProvisioning.PENDING)
+    forget_organisation_principals(Organisation.objects.filter(pk=organisation.pk))
+    organisation.stripe_provisioning_status = StripeProvisioning.PENDING
+    provision_stripe_account.enqueue(organisation.pk)
+    return True
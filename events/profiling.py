@@ -0,0 +1,128 @@
+"""
+Per-request timing of SQL, template rendering and Stripe calls, reported in a Server-Timing header and logged for
+slow requests. Enabled with the REQUEST_PROFILING setting.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .instrumentation import aobserve_queries, observe_queries, observe_stripe
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar("request_profile", default=None)
+
+
+class Profile:
+    """Total time and count per phase for one request, and the queries it ran with their durations"""
+
+    def __init__(self):
+        self.phases = {}
+        self.queries = []
+
+    def add(self, phase, duration):
+        total, count = self.phases.get(phase, (0.0, 0))
+        self.phases[phase] = (total + duration, count + 1)
+
+    def record_query(self, sql, duration):
+        self.add("sql", duration)
+        self.queries.append((duration, sql))
+
+    def top_queries(self, n):
+        return sorted(self.queries, key=lambda query: query[0], reverse=True)[:n]
+
+    def server_timing(self, total):
+        entries = [f'{phase};dur={duration * 1000:.1f};desc="{count}x"'
+                   for phase, (duration, count) in self.phases.items()]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent in the block to phase of the current request's profile, if it is being profiled"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(phase, time.perf_counter() - start)
+
+
+def record_stripe_request(duration, status, error):
+    """Stripe observer adding each request (retries included) to the stripe phase of the current request's profile"""
+    profile = _current.get()
+    if profile is not None:
+        profile.add("stripe", duration)
+
+
+class ProfilingMiddleware:
+    """
+    Times SQL (through the execute_wrapper shared with the metrics, see events.instrumentation), template rendering
+    and Stripe calls for each request and adds them to a Server-Timing header. Requests slower than
+    REQUEST_PROFILING_SLOW_MS are logged with their slowest queries. Should be first in MIDDLEWARE so the total covers
+    the other middleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_PROFILING:
+            raise MiddlewareNotUsed
+        observe_stripe(record_stripe_request)
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile = Profile()
+        token = _current.set(profile)
+        start = time.perf_counter()
+        try:
+            with observe_queries(profile.record_query):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile, start)
+
+    async def __acall__(self, request):
+        profile = Profile()
+        token = _current.set(profile)
+        start = time.perf_counter()
+        try:
+            async with aobserve_queries(profile.record_query):
+                response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile, start)
+
+    def finish(self, request, response, profile, start):
+        total = time.perf_counter() - start
+        response["Server-Timing"] = profile.server_timing(total)
+        if total * 1000 >= settings.REQUEST_PROFILING_SLOW_MS:
+            self.log_slow_request(request, profile, total)
+        return response
+
+    def process_template_response(self, request, response):
+        # Render here rather than leaving it to the handler so the time (including the template's queries) falls
+        # inside the profile; the handler skips rendering an already rendered response
+        with timed("template"):
+            response.render()
+        return response
+
+    def log_slow_request(self, request, profile, total):
+        queries = "".join(f"\n    {duration * 1000:.1f}ms {sql}"
+                          for duration, sql in profile.top_queries(settings.REQUEST_PROFILING_TOP_QUERIES))
+        logger.warning("Slow request %s %s took %.0fms (%s) with %d queries, slowest:%s", request.method,
+                       request.path, total * 1000, profile.server_timing(total), len(profile.queries), queries)
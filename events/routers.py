@@ -0,0 +1,133 @@
+"""
+Read replica routing with read-your-writes.
+
+During a request, reads go to a random replica from REPLICA_DATABASES whose replication lag is within
+REPLICA_MAX_LAG seconds, and writes go to default. Once a request writes, its later reads go to default, and the
+client gets a signed cookie keeping its reads on default for REPLICA_STICKY_SECONDS, so it sees its own order or
+claim straight away. Reads inside a transaction, and everything outside a request (task workers, management
+commands), always use default.
+"""
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import SynchronousOnlyOperation
+from django.core.signing import BadSignature
+from django.utils.crypto import constant_time_compare
+from django.db import DatabaseError, connections
+
+PIN_COOKIE = "primary_pin"
+
+_state = ContextVar("replica_routing", default=None)
+# alias -> (monotonic time checked, within lag tolerance)
+_freshness = {}
+
+LAG_SQL = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+
+class RoutingState:
+    """Whether the current request reads from default, and whether it has written"""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def replica_is_fresh(alias):
+    """Whether a replica's lag is within REPLICA_MAX_LAG, checked at most every REPLICA_LAG_CHECK_INTERVAL seconds"""
+    now = time.monotonic()
+    checked = _freshness.get(alias)
+    if checked is not None and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return checked[1]
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except SynchronousOnlyOperation:
+        # Routed from the event loop, keep the last answer until a sync caller rechecks
+        return True if checked is None else checked[1]
+    except DatabaseError:
+        lag = None
+    fresh = lag is not None and lag <= settings.REPLICA_MAX_LAG
+    _freshness[alias] = (now, fresh)
+    return fresh
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.pinned or not settings.REPLICA_DATABASES:
+            return "default"
+        if connections["default"].in_atomic_block:
+            return "default"
+        replicas = [alias for alias in settings.REPLICA_DATABASES if replica_is_fresh(alias)]
+        return random.choice(replicas) if replicas else "default"
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = state.pinned = True
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as default
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Routes the request's reads through ReplicaRouter, pinning them to default for clients holding a current pin cookie
+    and for microcache refreshes, and sets the cookie after a write
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(response, state)
+
+    async def __acall__(self, request):
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(response, state)
+
+    def start(self, request):
+        # Refreshed pages are cached by nginx, so they must not come from a lagging replica
+        secret = settings.MICROCACHE_REFRESH_SECRET
+        pinned = bool(secret) and constant_time_compare(request.headers.get("X-Microcache-Refresh", ""), secret)
+        try:
+            pinned = pinned or float(request.get_signed_cookie(PIN_COOKIE)) > time.time()
+        except (KeyError, BadSignature, ValueError):
+            pass
+        return RoutingState(pinned)
+
+    def finish(self, response, state):
+        if state.wrote:
+            window = settings.REPLICA_STICKY_SECONDS
+            response.set_signed_cookie(PIN_COOKIE, str(time.time() + window), max_age=window, httponly=True,
+                                       samesite="Lax")
+        return response
@@ -0,0 +1,144 @@
+from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import live, microcache, notifications
+from .auth import forget_organisation_principals, forget_principals
+from .models import Event, Order, Organisation, OrgUser, Serving, release_servings, touch_organisation
+
+
+def _is_parent_cascade(origin, model):
+    """True if the delete was started from a parent object (e.g. an Order for its Servings) rather than model itself"""
+    origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    return origin_model is not model
+
+
+@receiver(post_delete, sender=Serving)
+def release_deleted_servings(sender, instance, origin=None, **kwargs):
+    """Keeps Order.claimed_servings in sync for single, bulk (queryset) and admin deletes of servings"""
+    if origin is not None and _is_parent_cascade(origin, Serving):
+        return
+    release_servings(instance.order_id, instance.number_of_servings)
+    if Serving.order.is_cached(instance):
+        instance.order.claimed_servings = max(instance.order.claimed_servings - instance.number_of_servings, 0)
+
+
+def _order_counts(order_id):
+    counts = Order.objects.filter(pk=order_id).values('claimed_servings', 'available_servings').first()
+    if counts is None:
+        return {}
+    return {"claimed": counts['claimed_servings'],
+            "remaining": counts['available_servings'] - counts['claimed_servings']}
+
+
+def _action(signal, created):
+    if signal is post_delete:
+        return "deleted"
+    return "created" if created else "saved"
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def publish_event_change(sender, instance, signal, created=False, **kwargs):
+    delta = {"type": "event", "action": _action(signal, created), "locked": instance.locked}
+    live.publish_on_commit(instance.pk, lambda: delta)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def publish_order_change(sender, instance, signal, created=False, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Order):
+        return
+    delta = {"type": "order", "action": _action(signal, created), "order_id": instance.pk}
+    live.publish_on_commit(instance.event_id, lambda: {**delta, **_order_counts(delta["order_id"])})
+
+
+@receiver(post_save, sender=Serving)
+@receiver(post_delete, sender=Serving)
+def publish_serving_change(sender, instance, signal, created=False, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Serving):
+        return
+    delta = {"type": "serving", "action": _action(signal, created), "serving_id": instance.pk,
+             "order_id": instance.order_id, "buyer_name": instance.buyer_name,
+             "buyer_whatsapp": instance.buyer_whatsapp_display, "number_of_servings": instance.number_of_servings}
+    live.publish_on_commit(instance.order.event_id, lambda: {**delta, **_order_counts(delta["order_id"])})
+
+
+@receiver(pre_save, sender=Event)
+def remember_lock_state(sender, instance, **kwargs):
+    instance._was_locked = None
+    if instance.pk and instance.locked:
+        instance._was_locked = Event.objects.filter(pk=instance.pk).values_list('locked', flat=True).first()
+
+
+@receiver(post_save, sender=Event)
+def notify_event_locked(sender, instance, created, **kwargs):
+    if instance.locked and not created and instance._was_locked is False:
+        notifications.event_locked(instance)
+
+
+@receiver(post_save, sender=Serving)
+def notify_order_full(sender, instance, created, **kwargs):
+    # The claim's UPDATE holds the order row lock, so only the claim that fills the order sees it full
+    if created and Order.objects.filter(pk=instance.order_id, claimed_servings__gte=F('available_servings')).exists():
+        notifications.order_full(instance.order)
+
+
+@receiver(post_delete, sender=Serving)
+def notify_serving_cancelled(sender, instance, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Serving):
+        return
+    notifications.serving_cancelled(instance, instance.order)
+
+
+# Bumped after commit, so the organisation row isn't locked for the rest of the event write's transaction
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def touch_event_organisation(sender, instance, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Event):
+        return
+    transaction.on_commit(lambda: touch_organisation(instance.organisation_id))
+
+
+@receiver(post_save, sender=Organisation)
+def refresh_organisation_page(sender, instance, **kwargs):
+    microcache.refresh_on_commit(organisation_path=instance.path)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def refresh_event_pages(sender, instance, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Event):
+        return
+    microcache.refresh_on_commit(event_id=instance.pk, organisation_path=instance.organisation.path)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def refresh_order_event_page(sender, instance, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Order):
+        return
+    microcache.refresh_on_commit(event_id=instance.event_id)
+
+
+@receiver(post_save, sender=Serving)
+@receiver(post_delete, sender=Serving)
+def refresh_serving_event_page(sender, instance, origin=None, **kwargs):
+    if origin is not None and _is_parent_cascade(origin, Serving):
+        return
+    microcache.refresh_on_commit(event_id=instance.order.event_id)
+
+
+@receiver(post_save, sender=OrgUser)
+@receiver(post_delete, sender=OrgUser)
+def forget_user_principal(sender, instance, **kwargs):
+    forget_principals([instance.pk])
+
+
+# Before delete, while the organisation's users still point at it
+@receiver(post_save, sender=Organisation)
+@receiver(pre_delete, sender=Organisation)
+def forget_organisation_users(sender, instance, **kwargs):
+    forget_organisation_principals(Organisation.objects.filter(pk=instance.pk))
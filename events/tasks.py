@@ -0,0 +1,111 @@
+"""
+A small Postgres-backed background task queue.
+
+Functions decorated with @task can be queued with func.enqueue(*args, **kwargs). The Task row is written in the
+caller's transaction, so a task is only ever queued alongside the change that caused it. Workers started by the
+run_workers management command claim due tasks with SELECT ... FOR UPDATE SKIP LOCKED, retry failures with
+exponential backoff and mark tasks dead once they run out of attempts.
+"""
+import logging
+import traceback
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Task, TaskStatus
+
+logger = logging.getLogger(__name__)
+
+
+def task(max_attempts=5, on_dead=None):
+    """
+    Registers a function as a task. Arguments must be JSON serialisable. on_dead, if given, is called with the
+    task's arguments once it has failed max_attempts times.
+    """
+    def decorator(func):
+        func.task_name = f"{func.__module__}.{func.__qualname__}"
+        func.max_attempts = max_attempts
+        func.on_dead = on_dead
+        func.enqueue = partial(enqueue, func)
+        return func
+
+    return decorator
+
+
+def enqueue(func, *args, run_at=None, **kwargs) -> Task:
+    return Task.objects.create(name=func.task_name, args=list(args), kwargs=kwargs, max_attempts=func.max_attempts,
+                               run_at=run_at or timezone.now())
+
+
+def retry_delay(attempts) -> timedelta:
+    seconds = settings.TASK_RETRY_BACKOFF * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, settings.TASK_RETRY_BACKOFF_MAX))
+
+
+def claim_next_task():
+    """
+    Marks the next due task as running and returns it, or None if nothing is due. Tasks left running by a worker
+    that died are picked up again once TASK_TIMEOUT has passed.
+    """
+    now = timezone.now()
+    due = Q(status=TaskStatus.QUEUED, run_at__lte=now) | Q(
+        status=TaskStatus.RUNNING, started_at__lt=now - timedelta(seconds=settings.TASK_TIMEOUT))
+    with transaction.atomic():
+        claimed = Task.objects.select_for_update(skip_locked=True).filter(due).order_by('run_at').first()
+        if claimed is None:
+            return None
+        claimed.status = TaskStatus.RUNNING
+        claimed.attempts += 1
+        claimed.started_at = now
+        claimed.save(update_fields=['status', 'attempts', 'started_at'])
+    return claimed
+
+
+def run_task(claimed):
+    try:
+        func = import_string(claimed.name)
+        func(*claimed.args, **claimed.kwargs)
+    except Exception:
+        _record_failure(claimed, traceback.format_exc())
+    else:
+        claimed.delete()
+
+
+def _record_failure(claimed, error):
+    claimed.last_error = error
+    if claimed.attempts < claimed.max_attempts:
+        claimed.status = TaskStatus.QUEUED
+        claimed.run_at = timezone.now() + retry_delay(claimed.attempts)
+        logger.warning("Task %s failed (attempt %s/%s), retrying at %s", claimed.name, claimed.attempts,
+                       claimed.max_attempts, claimed.run_at)
+    else:
+        claimed.status = TaskStatus.DEAD
+        logger.error("Task %s failed %s times and is dead:\n%s", claimed.name, claimed.attempts, error)
+    claimed.save(update_fields=['status', 'run_at', 'last_error'])
+    if claimed.status == TaskStatus.DEAD:
+        try:
+            on_dead = import_string(claimed.name).on_dead
+            if on_dead:
+                on_dead(*claimed.args, **claimed.kwargs)
+        except Exception:
+            logger.exception("on_dead handler for task %s failed", claimed.name)
+
+
+def run_next_task() -> bool:
+    """Runs one due task, returning False if there was nothing to do"""
+    claimed = claim_next_task()
+    if claimed is None:
+        return False
+    run_task(claimed)
+    return True
+
+
+def requeue(queryset) -> int:
+    """Gives dead tasks a fresh set of attempts"""
+    return queryset.filter(status=TaskStatus.DEAD).update(status=TaskStatus.QUEUED, attempts=0,
+                                                          run_at=timezone.now())
@@ -0,0 +1,74 @@
+import threading
+from unittest import skipUnless
+
+from django.db import connection, connections
+from django.test import TransactionTestCase
+
+from .models import Order, Serving, ClaimStatus, claim_servings
+from .testing_utils import create_event, create_order, create_organisation
+
+
+@skipUnless(connection.vendor == "postgresql", "Row locking under concurrency needs PostgreSQL")
+class ClaimConcurrencyTests(TransactionTestCase):
+    claimants = 60
+
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org, servings_per_order=41)
+        self.orders = [create_order(event=self.event, available_servings=40) for _ in range(3)]
+
+    def _run_claimants(self, claims_per_thread, on_start=None):
+        # Times out, failing the test, rather than hanging if a claimant can't get a connection
+        barrier = threading.Barrier(self.claimants + (1 if on_start else 0), timeout=30)
+        results = []
+        results_lock = threading.Lock()
+
+        def claimant(index):
+            try:
+                order = Order.objects.select_related("event").get(pk=self.orders[index % len(self.orders)].pk)
+                barrier.wait()
+                for _ in range(claims_per_thread):
+                    status = claim_servings(order, f"Buyer {index}", "0871234567").status
+                    with results_lock:
+                        results.append(status)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=claimant, args=(i,)) for i in range(self.claimants)]
+        for thread in threads:
+            thread.start()
+        if on_start:
+            barrier.wait()
+            on_start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_claims_never_oversell(self):
+        """
+        60 threads racing to claim from 3 orders of 40 servings never claim more than is available.
+        :return:
+        """
+        results = self._run_claimants(claims_per_thread=5)
+        claimed = results.count(ClaimStatus.CLAIMED)
+        self.assertEqual(claimed, 120)
+        self.assertEqual(results.count(ClaimStatus.INSUFFICIENT), len(results) - 120)
+        for order in Order.objects.filter(event=self.event):
+            self.assertEqual(order.claimed_servings, order.count_claimed_servings())
+            self.assertLessEqual(order.claimed_servings, order.available_servings)
+
+    def test_no_claims_after_event_lock_commits(self):
+        """
+        Once locking the event has committed, every later claim is rejected as locked.
+        :return:
+        """
+        locked_at = []
+
+        def lock_event():
+            type(self.event).objects.filter(pk=self.event.pk).update(locked=True)
+            locked_at.append(Serving.objects.filter(order__event=self.event).count())
+
+        results = self._run_claimants(claims_per_thread=1, on_start=lock_event)
+        claimed = results.count(ClaimStatus.CLAIMED)
+        self.assertEqual(claimed + results.count(ClaimStatus.LOCKED), len(results))
+        self.assertEqual(Serving.objects.filter(order__event=self.event).count(), locked_at[0])
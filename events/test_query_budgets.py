@@ -0,0 +1,105 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from . import urls
+from .models import OrgUser
+from .testing_utils import QueryBudgetMixin, create_event, create_order, create_organisation, create_serving
+
+
+class ViewQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+    Every page in events.urls runs the same number of queries however many events, orders and servings are behind it,
+    within a fixed budget. Views that change data are also checked with a valid POST. The budgets leave a query or
+    two of headroom, lower them when a page gets cheaper.
+    """
+    # Not pages: covered by their own tests, or they call Stripe or stream
+    excluded = {"login", "logout", "stripe-onboarding", "stripe-webhook", "event-stream", "metrics"}
+
+    def setUp(self):
+        self.org = create_organisation()
+        self.user = OrgUser.objects.create_user(username="organiser", password="pw", organisation=self.org)
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+        self.serving = create_serving(order=self.order)
+        self.grown = 0
+
+    def grow(self, n):
+        """Adds n events to the organisation and n orders with servings to the event"""
+        for _ in range(n):
+            self.grown += 1
+            create_event(self.org, name=f"Event {self.grown}")
+            order = create_order(event=self.event)
+            create_serving(order=order, number_of_servings=2)
+            create_serving(order=order, number_of_servings=3)
+
+    # Valid form data for the views that create rows
+    order_data = {"purchaser_name": "Bob", "purchaser_whatsapp": "0879876543", "purchaser_email": "bob@example.com",
+                  "purchaser_revolut": "BobRev", "description": "Pep", "price_per_serving": 4, "available_servings": 7}
+    serving_data = {"buyer_name": "John", "buyer_whatsapp": "0871234567", "number_of_servings": 1}
+
+    def event_url(self, name, *args):
+        return reverse(f"events:{name}", args=[self.org.path, self.event.slug, *args])
+
+    def test_all_pages_covered(self):
+        tested = {name.removeprefix("test_").replace("_", "-") for name in dir(self) if name.startswith("test_")}
+        names = {pattern.name for pattern in urls.urlpatterns} - self.excluded
+        self.assertEqual(names - tested, set())
+
+    def test_home(self):
+        self.assertQueryCountConstant(reverse("events:home"), self.grow, budget=1)
+
+    def test_user(self):
+        self.assertQueryCountConstant(reverse("events:user", args=[self.user.username]), self.grow, budget=4)
+
+    def test_org_detail(self):
+        url = reverse("events:org-detail", args=[self.org.path])
+        self.assertQueryCountConstant(url, self.grow, budget=6)
+        self.assertQueryCountConstant(url, self.grow, user=self.user, budget=8)
+
+    def test_org_update(self):
+        self.assertQueryCountConstant(reverse("events:org-update", args=[self.org.path]), self.grow, user=self.user,
+                                      budget=5)
+
+    def test_event_create(self):
+        self.assertQueryCountConstant(reverse("events:event-create", args=[self.org.path]), self.grow, user=self.user,
+                                      budget=4)
+
+    def test_event_detail(self):
+        self.assertQueryCountConstant(self.event_url("event-detail"), self.grow, budget=6)
+        self.assertQueryCountConstant(self.event_url("event-detail"), self.grow, user=self.user, budget=8)
+
+    def test_event_edit(self):
+        self.assertQueryCountConstant(self.event_url("event-edit"), self.grow, user=self.user, budget=5)
+
+    def test_event_delete(self):
+        self.assertQueryCountConstant(self.event_url("event-delete"), self.grow, user=self.user, budget=5)
+
+        def url():
+            return reverse("events:event-delete", args=[self.org.path, create_event(self.org).slug])
+        self.assertQueryCountConstant(url, self.grow, user=self.user, budget=11, method="post")
+
+    def test_create_pizza_order(self):
+        url = self.event_url("create-pizza-order")
+        self.assertQueryCountConstant(url, self.grow, budget=4)
+        self.assertQueryCountConstant(url, self.grow, budget=5, method="post", data=self.order_data)
+
+    def test_order_delete(self):
+        self.assertQueryCountConstant(self.event_url("order-delete", self.order.pk), self.grow, user=self.user,
+                                      budget=5)
+
+        def url():
+            return self.event_url("order-delete", create_serving(order=create_order(event=self.event)).order_id)
+        self.assertQueryCountConstant(url, self.grow, user=self.user, budget=10, method="post")
+
+    def test_claim_servings(self):
+        url = reverse("events:claim-servings", args=[self.org.path, self.order.pk])
+        self.assertQueryCountConstant(url, self.grow, budget=5)
+        self.assertQueryCountConstant(url, self.grow, budget=12, method="post", data=self.serving_data)
+
+    def test_delete_servings(self):
+        self.assertQueryCountConstant(reverse("events:delete-servings", args=[self.org.path, self.serving.pk]),
+                                      self.grow, budget=4)
+
+        def url():
+            return reverse("events:delete-servings", args=[self.org.path, create_serving(order=self.order).pk])
+        self.assertQueryCountConstant(url, self.grow, budget=8, method="post")
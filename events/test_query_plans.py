@@ -0,0 +1,47 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from .models import Event, Order, Serving
+from .testing_utils import bulk_seed
+
+
+@skipUnless(connection.vendor == "postgresql", "Query plans are checked against PostgreSQL")
+class HotQueryPlanTests(TestCase):
+    """
+    Seeds ~10k events, 100k orders and 400k servings and checks the planner uses an index for each query behind the
+    organisation and event pages, rather than a sequential scan.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.orgs = bulk_seed(organisations=250, events_per_org=40, orders_per_event=10, servings_per_order=4)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        cls.org = cls.orgs[0]
+        cls.event = Event.objects.filter(organisation=cls.org).first()
+
+    def assertUsesIndex(self, queryset, table):
+        plan = queryset.explain()
+        self.assertNotIn(f"Seq Scan on {table}", plan, plan)
+        self.assertRegex(plan, rf"Index (Only )?Scan .*on {table}|Bitmap Index Scan", plan)
+
+    def test_org_page_public_events(self):
+        events = Event.objects.listed(self.org)
+        self.assertUsesIndex(events.filter(date__gte=timezone.now()), Event._meta.db_table)
+        self.assertUsesIndex(events.filter(date__lt=timezone.now()), Event._meta.db_table)
+
+    def test_org_page_all_events(self):
+        events = Event.objects.listed(self.org, include_private=True)
+        self.assertUsesIndex(events.filter(date__gte=timezone.now()), Event._meta.db_table)
+
+    def test_event_page_orders(self):
+        orders = Order.objects.filter(event=self.event).with_claim_stats()
+        self.assertUsesIndex(orders, Order._meta.db_table)
+
+    def test_event_page_servings(self):
+        order_ids = list(Order.objects.filter(event=self.event).values_list("id", flat=True))
+        servings = Serving.objects.filter(order__in=order_ids).order_by("id")
+        self.assertUsesIndex(servings, Serving._meta.db_table)
@@ -1,6 +1,16 @@
+import random
+import sys
+from collections import defaultdict
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
 from django.utils import timezone
 
+from .auth import principal_key
 from .models import Event, Order, Serving, Organisation
 
 mock_img = SimpleUploadedFile(name='test_image.png', content=b"file data")
@@ -26,3 +36,146 @@ def create_order(event, purchaser_name="Bob", purchaser_whatsapp="0879876543", p
 def create_serving(order, buyer_name="John", buyer_whatsapp="0871234567", number_of_servings=1):
     return Serving.objects.create(order=order, buyer_name=buyer_name, buyer_whatsapp=buyer_whatsapp,
                                   number_of_servings=number_of_servings)
+
+
+SEED_DISTRIBUTIONS = ("uniform", "skewed")
+
+
+def _seed_count(rng, mean, distribution):
+    """A count averaging mean: exactly mean when uniform, long-tailed (a few very busy ones) when skewed"""
+    if distribution == "uniform" or mean == 0:
+        return mean
+    # Pareto with alpha 2 has mean 2, so halving it keeps the requested mean
+    return min(int(mean * rng.paretovariate(2) / 2), mean * 50)
+
+
+@transaction.atomic
+def bulk_seed(organisations=50, events_per_org=40, orders_per_event=10, servings_per_order=4, seed=0,
+              distribution="uniform", private_ratio=0.3):
+    """
+    Creates a synthetic dataset with bulk_create: events spread over two years either side of now, private_ratio of
+    them private, with every order's claimed_servings matching its servings. With distribution="skewed" the number
+    of events per organisation and orders per event are long-tailed and orders are claimed unevenly, keeping roughly
+    the same totals. Returns the organisations.
+    """
+    if distribution not in SEED_DISTRIBUTIONS:
+        raise ValueError(f"Unknown distribution {distribution!r}, expected one of {SEED_DISTRIBUTIONS}")
+    rng = random.Random(seed)
+    now = timezone.now()
+    available = servings_per_order * 2 - 1
+    orgs = Organisation.objects.bulk_create(
+        Organisation(name=f"Seed Org {seed}-{i}", description="seeded", logo="logos/seed.png",
+                     path=f"seed-org-{seed}-{i}")
+        for i in range(organisations))
+    events = Event.objects.bulk_create(
+        (Event(organisation=org, name=f"Event {i}", date=now + timedelta(days=rng.randint(-730, 730)),
+               servings_per_order=servings_per_order * 2, private=rng.random() < private_ratio)
+         for org in orgs for i in range(_seed_count(rng, events_per_org, distribution))), batch_size=5000)
+    orders = Order.objects.bulk_create(
+        (Order(event=event, purchaser_name="Seed", purchaser_whatsapp="+353871234567",
+               purchaser_whatsapp_display="+353 87 123 4567", purchaser_revolut="seed",
+               description="Pep", price_per_serving=4, available_servings=available,
+               claimed_servings=servings_per_order if distribution == "uniform" else rng.randint(0, available))
+         for event in events for _ in range(_seed_count(rng, orders_per_event, distribution))), batch_size=5000)
+    Serving.objects.bulk_create(
+        (Serving(order=order, buyer_name="Seed", buyer_whatsapp="+353871234567",
+                 buyer_whatsapp_display="+353 87 123 4567", number_of_servings=1)
+         for order in orders for _ in range(order.claimed_servings)), batch_size=5000)
+    return orgs
+
+
+class CapturedQueries:
+    """
+    Records each query run inside the context with the innermost project (not Django or third party) frame that
+    issued it, using connection.execute_wrapper.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._wrapper.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, _call_site()))
+        return execute(sql, params, many, context)
+
+    def by_call_site(self):
+        """Returns {call site: [sql, ...]} with the busiest call sites first"""
+        grouped = defaultdict(list)
+        for sql, site in self.queries:
+            grouped[site].append(sql)
+        return dict(sorted(grouped.items(), key=lambda item: -len(item[1])))
+
+    def report(self):
+        lines = []
+        for site, statements in self.by_call_site().items():
+            lines.append(f"{len(statements)} quer{'y' if len(statements) == 1 else 'ies'} from {site}:")
+            lines.extend(f"    {sql}" for sql in statements)
+        return "\n".join(lines)
+
+
+def _call_site():
+    """
+    The innermost frame of the current stack in this project's code, skipping this module, or the template line
+    being rendered if that comes first (e.g. a related manager looked up in a {% for %} loop).
+    """
+    base_dir = str(settings.BASE_DIR)
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        node = frame.f_locals.get("self") if frame.f_code.co_name == "render_annotated" else None
+        if node is not None and getattr(node, "origin", None) is not None:
+            return f"{node.origin.template_name}:{node.token.lineno}"
+        if filename.startswith(base_dir) and "site-packages" not in filename and filename != __file__:
+            return f"{Path(filename).relative_to(base_dir)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "<unknown>"
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin checking that a page's query count doesn't grow with the amount of data behind it. Each test
+    requests a URL, calls grow() to add more rows of the kind the page lists and requests it again, failing with the
+    offending SQL grouped by call site when the counts differ or exceed a fixed budget.
+    """
+
+    def capture_queries(self, url, user=None, method="get", data=None):
+        if user is not None:
+            self.client.force_login(user)
+            # Count the uncached user lookup, the worst case
+            cache.delete(principal_key(user.pk))
+        with CapturedQueries() as captured:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400, f"{method.upper()} {url} returned {response.status_code}")
+        return captured
+
+    def assertQueryCountConstant(self, url, grow, user=None, budget=None, sizes=(1, 10), method="get", data=None):
+        """
+        Requests url (as user, if given) after growing the data to each of sizes in turn by calling grow(n) with the
+        number of rows to add, and fails if the query count changes between sizes or goes over budget. url can be a
+        callable returning the URL, called outside the count before each request, e.g. to create the object a POST
+        deletes.
+        """
+        counts = []
+        seeded = 0
+        for size in sizes:
+            grow(size - seeded)
+            seeded = size
+            target = url() if callable(url) else url
+            captured = self.capture_queries(target, user, method, data)
+            counts.append(captured)
+            if len(captured) != len(counts[0]):
+                self.fail(f"{method.upper()} {target} ran {len(counts[0])} queries at size {sizes[0]} but "
+                          f"{len(captured)} at size {size}:\n{captured.report()}")
+        if budget is not None and len(counts[-1]) > budget:
+            self.fail(f"{method.upper()} {target} ran {len(counts[-1])} queries, over its budget of {budget}:\n"
+                      f"{counts[-1].report()}")
@@ -1,6 +1,28 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (auth, benchmarks, checks, fragments, instrumentation, live, metrics, notifications, payments, routers,
+               tasks, views)
+from .mail import send_email
+from .models import Event, EventArchive, Order, Organisation, OrgUser, StripeProvisioning, Serving, Task, TaskStatus, Notification, ClaimStatus, claim_servings
 
 from .testing_utils import create_event, create_order, create_serving, create_organisation
 
@@ -184,3 +206,1340 @@ class ServingModelTests(TestCase):
         create_serving(order=self.order, number_of_servings=available - 1)
         with self.assertRaisesRegex(ValidationError, "Insufficient"):
             create_serving(order=self.order, number_of_servings=2)
+
+
+class OrderQuerySetTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+
+    def test_with_claim_stats_matches_model_methods(self):
+        """
+        with_claim_stats() annotations agree with get_total_claimed() and get_total_remaining().
+        :return:
+        """
+        create_serving(order=self.order, number_of_servings=2)
+        create_serving(order=self.order, number_of_servings=3)
+        empty_order = create_order(event=self.event)
+        orders = {order.id: order for order in Order.objects.filter(event=self.event).with_claim_stats()}
+        self.assertEqual(orders[self.order.id].total_claimed, self.order.get_total_claimed())
+        self.assertEqual(orders[self.order.id].total_remaining, self.order.get_total_remaining())
+        self.assertEqual(len(orders[self.order.id].prefetched_servings), 2)
+        self.assertEqual(orders[empty_order.id].total_claimed, 0)
+        self.assertEqual(orders[empty_order.id].total_remaining, empty_order.available_servings)
+        self.assertEqual(orders[empty_order.id].prefetched_servings, [])
+
+
+class EventDetailViewTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+
+    def _count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_orders(self):
+        """
+        The event page issues the same number of queries regardless of how many orders and servings it shows.
+        :return:
+        """
+        create_serving(order=create_order(event=self.event))
+        baseline = self._count_queries()
+        for _ in range(5):
+            order = create_order(event=self.event)
+            create_serving(order=order, number_of_servings=2)
+            create_serving(order=order, number_of_servings=3)
+        self.assertEqual(self._count_queries(), baseline)
+
+
+class ClaimedServingsCounterTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+
+    def _stored_total(self):
+        return Order.objects.values_list('claimed_servings', flat=True).get(pk=self.order.pk)
+
+    def test_counter_tracks_created_servings(self):
+        """
+        Creating servings increments the persisted counter.
+        :return:
+        """
+        create_serving(order=self.order, number_of_servings=2)
+        create_serving(order=self.order, number_of_servings=3)
+        self.assertEqual(self._stored_total(), 5)
+
+    def test_counter_unchanged_when_claim_rejected(self):
+        """
+        A serving rejected for insufficient servings leaves the counter untouched.
+        :return:
+        """
+        create_serving(order=self.order, number_of_servings=6)
+        with self.assertRaisesRegex(ValidationError, "Insufficient"):
+            create_serving(order=self.order, number_of_servings=2)
+        self.assertEqual(self._stored_total(), 6)
+
+    def test_counter_tracks_queryset_delete(self):
+        """
+        Bulk deletes through a queryset (as the admin delete action does) decrement the counter.
+        :return:
+        """
+        for _ in range(3):
+            create_serving(order=self.order, number_of_servings=2)
+        Serving.objects.filter(pk__in=list(Serving.objects.values_list('pk', flat=True)[:2])).delete()
+        self.assertEqual(self._stored_total(), 2)
+
+    def test_reconcile_repairs_drift(self):
+        """
+        reconcile_claim_counters resets drifted counters to the servings total.
+        :return:
+        """
+        create_serving(order=self.order, number_of_servings=3)
+        Order.objects.filter(pk=self.order.pk).update(claimed_servings=6)
+        call_command('reconcile_claim_counters', '--dry-run', stdout=StringIO())
+        self.assertEqual(self._stored_total(), 6)
+        call_command('reconcile_claim_counters', '--batch-size', '1', stdout=StringIO())
+        self.assertEqual(self._stored_total(), 3)
+
+
+class ClaimServingsTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+
+    def test_claim_returns_serving(self):
+        """
+        claim_servings() returns a claimed result with the created serving.
+        :return:
+        """
+        result = claim_servings(self.order, "John", "0871234567", number_of_servings=2)
+        self.assertEqual(result.status, ClaimStatus.CLAIMED)
+        self.assertTrue(result.claimed)
+        self.assertEqual(result.serving.order, self.order)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).claimed_servings, 2)
+
+    def test_claim_insufficient(self):
+        """
+        claim_servings() returns insufficient without creating a serving if the order doesn't have enough remaining.
+        :return:
+        """
+        result = claim_servings(self.order, "John", "0871234567", number_of_servings=8)
+        self.assertEqual(result.status, ClaimStatus.INSUFFICIENT)
+        self.assertIsNone(result.serving)
+        self.assertFalse(self.order.matched_servings().exists())
+
+    def test_claim_locked_in_database(self):
+        """
+        claim_servings() checks the stored lock, not just the in-memory event.
+        :return:
+        """
+        Event.objects.filter(pk=self.event.pk).update(locked=True)
+        result = claim_servings(self.order, "John", "0871234567")
+        self.assertEqual(result.status, ClaimStatus.LOCKED)
+        self.assertFalse(self.order.matched_servings().exists())
+
+    def test_claim_view_shows_error_when_insufficient(self):
+        """
+        The claim view re-renders the form with an error instead of failing when the order is full.
+        :return:
+        """
+        create_serving(order=self.order, number_of_servings=7)
+        url = reverse("events:claim-servings", kwargs={"path": self.org.path, "pk": self.order.pk})
+        response = self.client.post(url, {"buyer_name": "John", "buyer_whatsapp": "0871234567",
+                                          "number_of_servings": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "not enough servings remaining")
+        self.assertEqual(self.order.matched_servings().count(), 1)
+
+
+class LiveUpdatesTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+
+    def test_serving_changes_published_after_commit(self):
+        """
+        Claiming and deleting servings publish deltas with the order's updated counts once committed.
+        :return:
+        """
+        broker = mock.Mock()
+        with mock.patch.object(live, "get_broker", return_value=broker):
+            with self.captureOnCommitCallbacks(execute=True):
+                serving = create_serving(order=self.order, number_of_servings=3)
+            with self.captureOnCommitCallbacks(execute=True):
+                serving.delete()
+        claimed, deleted = [c.args for c in broker.publish.call_args_list]
+        self.assertEqual(claimed[0], self.event.pk)
+        self.assertEqual(claimed[1]["type"], "serving")
+        self.assertEqual(claimed[1]["action"], "created")
+        self.assertEqual((claimed[1]["claimed"], claimed[1]["remaining"]), (3, 4))
+        self.assertEqual(deleted[1]["action"], "deleted")
+        self.assertEqual((deleted[1]["claimed"], deleted[1]["remaining"]), (0, 7))
+
+    def test_in_process_broker_streams_deltas(self):
+        """
+        stream_deltas() yields published deltas for its event only, as server-sent event messages.
+        :return:
+        """
+        broker = live.InProcessBroker()
+
+        async def read_stream():
+            stream = live.stream_deltas(1)
+            self.assertTrue((await anext(stream)).startswith("retry:"))
+            pending = asyncio.ensure_future(anext(stream))
+            await asyncio.sleep(0)
+            broker.publish(2, {"type": "order", "order_id": 5})
+            broker.publish(1, {"type": "order", "order_id": 4})
+            message = await asyncio.wait_for(pending, timeout=1)
+            await stream.aclose()
+            return message
+
+        with mock.patch.object(live, "get_broker", return_value=broker):
+            message = asyncio.run(read_stream())
+        self.assertEqual(message, 'data: {"type": "order", "order_id": 4}\n\n')
+        self.assertEqual(broker._subscribers, {})
+
+    @override_settings(SERVER_MODE='wsgi')
+    def test_stream_disabled_under_wsgi(self):
+        """
+        Under WSGI the stream answers 204 and the event page doesn't open it, as WSGI can't stream it.
+        :return:
+        """
+        args = [self.org.path, self.event.slug]
+        self.assertEqual(self.client.get(reverse("events:event-stream", args=args)).status_code, 204)
+        self.assertNotContains(self.client.get(reverse("events:event-detail", args=args)), "EventSource")
+
+
+# Not in a TestCase transaction, whose connection can't be closed
+class LiveStreamConnectionTests(TransactionTestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+
+    async def test_open_stream_holds_no_connection(self):
+        """
+        The stream gives its database connection back once the event is found, rather than when the stream ends.
+        :return:
+        """
+        response = await self.async_client.get(reverse("events:event-stream", args=[self.org.path, self.event.slug]))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        open_connections = await sync_to_async(lambda: [c.alias for c in connections.all() if c.connection])()
+        self.assertEqual(open_connections, [])
+
+
+class StripeAccountStub:
+    """Stands in for stripe.Account, returning an account with the given capabilities"""
+
+    def __init__(self, charges_enabled=True, payouts_enabled=True):
+        self.account = {"charges_enabled": charges_enabled, "payouts_enabled": payouts_enabled}
+        self.retrieved = []
+
+    def retrieve(self, account_id):
+        self.retrieved.append(account_id)
+        return {"id": account_id, **self.account}
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET="whsec_test")
+class StripeVerificationTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.org.stripe_account_id = "acct_test"
+        self.org.save()
+
+    def _post_webhook(self, event, secret="whsec_test"):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return self.client.post(reverse("events:stripe-webhook"), payload, content_type="application/json",
+                                HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}")
+
+    def _account_updated(self, charges_enabled=True, payouts_enabled=True):
+        return {"id": "evt_test", "object": "event", "type": "account.updated", "data": {"object": {
+            "id": "acct_test", "object": "account", "charges_enabled": charges_enabled,
+            "payouts_enabled": payouts_enabled}}}
+
+    def test_refresh_account_verification(self):
+        """
+        refresh_account_verification() stores the verified status reported by Stripe.
+        :return:
+        """
+        stub = StripeAccountStub()
+        with mock.patch.object(payments.stripe, "Account", stub):
+            self.assertTrue(payments.refresh_account_verification("acct_test"))
+        self.assertEqual(stub.retrieved, ["acct_test"])
+        self.assertTrue(Organisation.objects.get(pk=self.org.pk).stripe_account_verified)
+
+    def test_refresh_scheduled_once_per_ttl(self):
+        """
+        schedule_verification_refresh() only queues one Stripe check per TTL window.
+        :return:
+        """
+        payments.cache.clear()
+        self.assertTrue(payments.schedule_verification_refresh(self.org))
+        self.assertFalse(payments.schedule_verification_refresh(self.org))
+        self.assertEqual(Task.objects.filter(name=payments.refresh_account_verification.task_name).count(), 1)
+
+    def test_webhook_marks_account_verified(self):
+        """
+        A signed account.updated webhook flips the organisation's verified flag.
+        :return:
+        """
+        response = self._post_webhook(self._account_updated())
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Organisation.objects.get(pk=self.org.pk).stripe_account_verified)
+
+    def test_webhook_rejects_bad_signature(self):
+        """
+        Webhooks signed with the wrong secret are rejected and ignored.
+        :return:
+        """
+        response = self._post_webhook(self._account_updated(), secret="whsec_wrong")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Organisation.objects.get(pk=self.org.pk).stripe_account_verified)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET="")
+    def test_webhook_disabled_without_secret(self):
+        """
+        Without a webhook secret the endpoint is disabled, rather than accepting webhooks signed with an empty key.
+        :return:
+        """
+        response = self._post_webhook(self._account_updated(), secret="")
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Organisation.objects.get(pk=self.org.pk).stripe_account_verified)
+
+
+class StripeOnboardingViewTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.org.stripe_account_id = "acct_test"
+        self.org.save()
+        self.user = OrgUser.objects.create_user(username="organiser", password="pw", organisation=self.org)
+        self.client.force_login(self.user)
+        self.url = reverse("events:stripe-onboarding", kwargs={"username": "organiser"})
+
+    def test_profile_page_makes_no_stripe_calls(self):
+        """
+        Rendering the profile page doesn't create an account link.
+        :return:
+        """
+        with mock.patch.object(payments.stripe.AccountLink, "create") as create, \
+                mock.patch.object(payments, "schedule_verification_refresh"):
+            response = self.client.get(reverse("events:user", kwargs={"username": "organiser"}))
+        self.assertContains(response, self.url)
+        create.assert_not_called()
+
+    def test_unverified_org_redirected_to_onboarding_link(self):
+        """
+        Clicking the link creates an onboarding link for the organisation's account and redirects to it.
+        :return:
+        """
+        with mock.patch.object(payments.stripe.AccountLink, "create",
+                               return_value={"url": "https://connect.stripe.test/setup"}) as create:
+            response = self.client.get(self.url)
+        self.assertRedirects(response, "https://connect.stripe.test/setup", fetch_redirect_response=False)
+        self.assertEqual(create.call_args.kwargs["account"], "acct_test")
+
+    def test_verified_org_skips_account_link(self):
+        """
+        Verified organisations go straight to the Stripe dashboard without an API call.
+        :return:
+        """
+        Organisation.objects.filter(pk=self.org.pk).update(stripe_account_verified=True)
+        with mock.patch.object(payments.stripe.AccountLink, "create") as create:
+            response = self.client.get(self.url)
+        self.assertRedirects(response, "https://dashboard.stripe.com/", fetch_redirect_response=False)
+        create.assert_not_called()
+
+    def test_other_users_cannot_create_links(self):
+        """
+        Users can only open the onboarding link for their own account.
+        :return:
+        """
+        OrgUser.objects.create_user(username="other", password="pw")
+        response = self.client.get(reverse("events:stripe-onboarding", kwargs={"username": "other"}))
+        self.assertRedirects(response, reverse("events:user", kwargs={"username": "other"}),
+                             fetch_redirect_response=False)
+
+
+class StripeProvisioningTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+
+    def test_provisioning_retries_with_same_idempotency_key(self):
+        """
+        A failed account creation is retried by the task queue with the same idempotency key.
+        :return:
+        """
+        payments.schedule_account_provisioning(self.org)
+        create = mock.Mock(side_effect=[payments.stripe.APIConnectionError("down"), {"id": "acct_new"}])
+        with mock.patch.object(payments.stripe.Account, "create", create):
+            self.assertTrue(tasks.run_next_task())
+            Task.objects.update(run_at=timezone.now())
+            self.assertTrue(tasks.run_next_task())
+        keys = {c.kwargs["idempotency_key"] for c in create.call_args_list}
+        self.assertEqual(keys, {payments.provisioning_idempotency_key(self.org.pk)})
+        self.org.refresh_from_db()
+        self.assertEqual(self.org.stripe_account_id, "acct_new")
+        self.assertEqual(self.org.stripe_provisioning_status, StripeProvisioning.PROVISIONED)
+        self.assertFalse(Task.objects.exists())
+
+    def test_provisioning_gets_past_stored_error(self):
+        """
+        When Stripe replays an error stored against the idempotency key, the account is created with a new key, which
+        later retries keep using.
+        :return:
+        """
+        stored = payments.stripe.APIError("stored", http_status=500, headers={"Idempotent-Replayed": "true"})
+        create = mock.Mock(side_effect=[stored, payments.stripe.APIConnectionError("timeout"), {"id": "acct_new"}])
+        with mock.patch.object(payments.stripe.Account, "create", create):
+            with self.assertRaises(payments.stripe.APIConnectionError):
+                payments.provision_stripe_account(self.org.pk)
+            self.assertEqual(payments.provision_stripe_account(self.org.pk), "acct_new")
+        keys = [c.kwargs["idempotency_key"] for c in create.call_args_list]
+        self.assertEqual(keys, [payments.provisioning_idempotency_key(self.org.pk)]
+                         + [payments.provisioning_idempotency_key(self.org.pk, 1)] * 2)
+        self.org.refresh_from_db()
+        self.assertEqual(self.org.stripe_account_id, "acct_new")
+
+    def test_provisioning_marks_failure_when_task_dies(self):
+        """
+        Provisioning is recorded as failed once the task has used up its attempts.
+        :return:
+        """
+        payments.schedule_account_provisioning(self.org)
+        Task.objects.update(max_attempts=2)
+        create = mock.Mock(side_effect=payments.stripe.APIConnectionError("down"))
+        with mock.patch.object(payments.stripe.Account, "create", create):
+            while Task.objects.filter(status=TaskStatus.QUEUED).update(run_at=timezone.now()):
+                tasks.run_next_task()
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(Task.objects.get().status, TaskStatus.DEAD)
+        self.org.refresh_from_db()
+        self.assertEqual(self.org.stripe_provisioning_status, StripeProvisioning.FAILED)
+
+    def test_existing_account_not_reprovisioned(self):
+        """
+        Organisations that already have an account are never given a new one.
+        :return:
+        """
+        self.org.stripe_account_id = "acct_existing"
+        self.org.save()
+        with mock.patch.object(payments.stripe.Account, "create") as create:
+            self.assertFalse(payments.schedule_account_provisioning(self.org))
+            self.assertEqual(payments.provision_stripe_account(self.org.pk), "acct_existing")
+        create.assert_not_called()
+
+    def test_admin_save_does_not_call_stripe(self):
+        """
+        Editing an organisation in the admin only queues provisioning, and only when it has no account.
+        :return:
+        """
+        admin_user = OrgUser.objects.create_superuser(username="admin", password="pw")
+        self.client.force_login(admin_user)
+        url = reverse("admin:events_organisation_change", args=[self.org.pk])
+        data = {"name": self.org.name, "description": "new description", "logo": ""}
+        with mock.patch.object(payments.stripe.Account, "create") as create:
+            self.client.post(url, data)
+            self.assertEqual(Task.objects.count(), 1)
+            Organisation.objects.filter(pk=self.org.pk).update(stripe_account_id="acct_existing")
+            self.client.post(url, data)
+            self.assertEqual(Task.objects.count(), 1)
+        create.assert_not_called()
+
+
+flaky_task_calls = []
+
+
+@tasks.task(max_attempts=2)
+def flaky_task(fail_times):
+    """Fails the first fail_times times it is run"""
+    flaky_task_calls.append(fail_times)
+    if len(flaky_task_calls) <= fail_times:
+        raise RuntimeError("flaky")
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        flaky_task_calls.clear()
+
+    def _make_due(self):
+        Task.objects.update(run_at=timezone.now())
+
+    def test_task_retried_with_backoff_then_deleted(self):
+        """
+        A failing task is requeued after a backoff delay, and deleted once it succeeds.
+        :return:
+        """
+        task = flaky_task.enqueue(1)
+        self.assertTrue(tasks.run_next_task())
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (TaskStatus.QUEUED, 1))
+        self.assertGreater(task.run_at, timezone.now())
+        self.assertIn("flaky", task.last_error)
+        self.assertFalse(tasks.run_next_task())
+        self._make_due()
+        self.assertTrue(tasks.run_next_task())
+        self.assertEqual(len(flaky_task_calls), 2)
+        self.assertFalse(Task.objects.exists())
+
+    def test_scheduled_task_waits_until_due(self):
+        """
+        Tasks scheduled in the future aren't claimed early.
+        :return:
+        """
+        flaky_task.enqueue(0, run_at=timezone.now() + timezone.timedelta(minutes=5))
+        self.assertIsNone(tasks.claim_next_task())
+
+    def test_dead_tasks_can_be_requeued(self):
+        """
+        Tasks that use up their attempts are dead-lettered and can be requeued.
+        :return:
+        """
+        task = flaky_task.enqueue(5)
+        tasks.run_next_task()
+        self._make_due()
+        tasks.run_next_task()
+        task.refresh_from_db()
+        self.assertEqual(task.status, TaskStatus.DEAD)
+        self.assertFalse(tasks.run_next_task())
+        self.assertEqual(tasks.requeue(Task.objects.all()), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (TaskStatus.QUEUED, 0))
+
+    @override_settings(EMAIL_BACKEND="events.mail.QueuedEmailBackend",
+                       TASK_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    def test_queued_email_sent_by_worker(self):
+        """
+        Mail sent during a request is queued, and delivered when the worker runs the task.
+        :return:
+        """
+        from django.core.mail import EmailMultiAlternatives
+        message = EmailMultiAlternatives("Reset", "text body", "noreply@pizzapool.app", ["someone@example.com"])
+        message.attach_alternative("<p>html body</p>", "text/html")
+        message.send()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Task.objects.get().name, send_email.task_name)
+        self.assertTrue(tasks.run_next_task())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Reset")
+        self.assertEqual(mail.outbox[0].alternatives, [("<p>html body</p>", "text/html")])
+        self.assertFalse(Task.objects.exists())
+
+
+@override_settings(TASK_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org, servings_per_order=101)
+        self.order = create_order(event=self.event, available_servings=100)
+        Order.objects.filter(pk=self.order.pk).update(purchaser_email="purchaser@example.com")
+        self.order.purchaser_email = "purchaser@example.com"
+
+    def _flush(self):
+        Task.objects.update(run_at=timezone.now())
+        with mock.patch.object(notifications, "get_connection", wraps=notifications.get_connection) as connect:
+            while tasks.run_next_task():
+                pass
+        return connect.call_count
+
+    def test_claim_burst_sent_over_one_connection(self):
+        """
+        100 claims filling an order, plus cancellations, send one email per recipient over a single connection.
+        :return:
+        """
+        for i in range(100):
+            claim_servings(self.order, f"Buyer {i}", "0871234567", buyer_email=f"buyer{i}@example.com")
+        for serving in Serving.objects.filter(order=self.order)[:10]:
+            serving.delete()
+        self.assertEqual(Task.objects.filter(name=notifications.send_notifications.task_name).count(), 1)
+        self.assertEqual(self._flush(), 1)
+        self.assertEqual(len(mail.outbox), 101)
+        self.assertFalse(Notification.objects.exists())
+        purchaser_mail = next(m for m in mail.outbox if m.to == ["purchaser@example.com"])
+        self.assertEqual(purchaser_mail.subject, "[pizzapool] 11 pizzapool updates")
+        self.assertIn("Order full", purchaser_mail.body)
+
+    def test_event_locked_notifies_once(self):
+        """
+        Locking an event notifies purchasers and claimants, re-saving a locked event doesn't.
+        :return:
+        """
+        claim_servings(self.order, "John", "0871234567", buyer_email="john@example.com")
+        self.event.locked = True
+        self.event.save()
+        self.event.save()
+        self.assertEqual(self._flush(), 1)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ["john@example.com", "purchaser@example.com"])
+        self.assertTrue(all(m.subject == "[pizzapool] Event locked: Test Event" for m in mail.outbox))
+
+    def test_failed_send_requeues_only_unsent(self):
+        """
+        If sending fails partway, the digests already sent are not queued again, the rest are.
+        :return:
+        """
+        notifications.notify(["a@example.com", "b@example.com", "c@example.com"], "Subject", "Message")
+        connection = mock.MagicMock()
+        connection.__enter__.return_value = connection
+        connection.send_messages.side_effect = [1, ConnectionError("SMTP went away")]
+        with mock.patch.object(notifications, "get_connection", return_value=connection):
+            with self.assertRaises(ConnectionError):
+                notifications.send_notifications()
+        self.assertEqual(sorted(Notification.objects.values_list("recipient", flat=True)),
+                         ["b@example.com", "c@example.com"])
+
+
+class BenchmarkTests(TestCase):
+    def test_seed_benchmark_data_keeps_counters_consistent(self):
+        """
+        Seeded orders' claimed_servings match their seeded servings, also with the skewed distribution.
+        :return:
+        """
+        call_command('seed_benchmark_data', '--organisations', '3', '--events-per-org', '4', '--orders-per-event', '3',
+                     '--distribution', 'skewed', stdout=StringIO())
+        self.assertEqual(Organisation.objects.count(), 3)
+        for order in Order.objects.all():
+            self.assertEqual(order.claimed_servings, order.count_claimed_servings())
+
+    def test_run_benchmarks_writes_results_and_compares_with_baseline(self):
+        """
+        run_benchmarks writes timings and query counts per page, and compare() flags pages whose query count grew.
+        :return:
+        """
+        call_command('seed_benchmark_data', '--organisations', '2', '--events-per-org', '2', stdout=StringIO())
+        with tempfile.TemporaryDirectory() as tmp:
+            output, baseline = f"{tmp}/results.json", f"{tmp}/baseline.json"
+            call_command('run_benchmarks', '--iterations', '2', '--warmup', '0', '--output', output,
+                         '--baseline', baseline, '--update-baseline', stdout=StringIO())
+            with open(output) as f:
+                results = json.load(f)["results"]
+            self.assertIn('event_detail', results)
+            self.assertEqual(set(results['event_detail']), {'url', 'iterations', 'p50_ms', 'p95_ms', 'max_ms',
+                                                            'queries'})
+
+            regressed = {name: dict(result, queries=result['queries'] + 1) for name, result in results.items()}
+            self.assertEqual(len(benchmarks.compare(regressed, results)), len(results))
+            self.assertEqual(benchmarks.compare(results, results), [])
+
+
+@override_settings(REQUEST_PROFILING=True, REQUEST_PROFILING_SLOW_MS=10_000)
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        create_serving(order=create_order(event=self.event))
+        self.url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+
+    def test_server_timing_header(self):
+        """
+        Profiled requests report the time spent in SQL, in templates and in total in a Server-Timing header.
+        :return:
+        """
+        response = self.client.get(self.url)
+        timing = response["Server-Timing"]
+        for phase in ("sql;", "template;", "total;"):
+            self.assertIn(phase, timing)
+
+    def test_slow_requests_logged_with_queries(self):
+        """
+        Requests slower than REQUEST_PROFILING_SLOW_MS are logged as a warning with their queries.
+        :return:
+        """
+        with override_settings(REQUEST_PROFILING_SLOW_MS=0), self.assertLogs("events.profiling", "WARNING") as logs:
+            self.client.get(self.url)
+        self.assertIn("SELECT", logs.output[0])
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_shares_query_wrapper_with_metrics(self):
+        """
+        With metrics enabled as well, both middleware observe the request's queries through a single execute_wrapper.
+        :return:
+        """
+        with mock.patch.object(instrumentation, "QueryObservers", wraps=instrumentation.QueryObservers) as observers:
+            response = self.client.get(self.url)
+        self.assertEqual(observers.call_count, 1)
+        self.assertIn("sql;", response["Server-Timing"])
+        content = self.client.get(reverse("events:metrics")).content.decode()
+        self.assertIn('pizzapool_db_queries_per_request_count{view="events:event-detail"}', content)
+
+    @override_settings(REQUEST_PROFILING=False)
+    def test_disabled(self):
+        """
+        No Server-Timing header is added when REQUEST_PROFILING is off.
+        :return:
+        """
+        self.assertNotIn("Server-Timing", self.client.get(self.url))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+
+    def test_requests_recorded_per_view(self):
+        """
+        Each request is counted with its method, status and view, and its query count observed per view.
+        :return:
+        """
+        self.client.get(reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug}))
+        response = self.client.get(reverse("events:metrics"))
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('pizzapool_http_requests_total{method="GET",status="200",view="events:event-detail"}', content)
+        self.assertIn('pizzapool_db_queries_per_request_count{view="events:event-detail"}', content)
+
+    def test_unknown_methods_share_a_label(self):
+        """
+        Request methods other than the standard ones are counted under "other", so clients can't add label values.
+        :return:
+        """
+        url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+        self.client.generic("FOO", url)
+        content = self.client.get(reverse("events:metrics")).content.decode()
+        self.assertIn('method="other"', content)
+        self.assertNotIn('method="FOO"', content)
+
+    @override_settings(METRICS_TOKEN="token")
+    def test_token_required(self):
+        """
+        With METRICS_TOKEN set, the metrics are only served to requests bearing it.
+        :return:
+        """
+        self.assertEqual(self.client.get(reverse("events:metrics")).status_code, 403)
+        response = self.client.get(reverse("events:metrics"), headers={"Authorization": "Bearer token"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_stripe_errors_counted(self):
+        """
+        Stripe API responses with an error status are counted by status code.
+        :return:
+        """
+        client = mock.Mock()
+        client.request_with_retries.return_value = ("{}", 500, {})
+        before = metrics.STRIPE_ERRORS.labels("500")._value.get()
+        metrics.instrument_stripe()
+        instrumentation.InstrumentedStripeClient(client).request_with_retries("get", "https://api.stripe.com", {})
+        self.assertEqual(metrics.STRIPE_ERRORS.labels("500")._value.get(), before + 1)
+
+    def test_email_send_observed(self):
+        """
+        The time taken to send an email is recorded in the email latency histogram.
+        :return:
+        """
+        before = metrics.EMAIL_LATENCY._sum.get()
+        with mock.patch("time.perf_counter", side_effect=[0.0, 1.5]):
+            with metrics.observe_email_send():
+                pass
+        self.assertEqual(metrics.EMAIL_LATENCY._sum.get(), before + 1.5)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+        self.event_url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+        self.org_url = reverse("events:org-detail", kwargs={"path": self.org.path})
+
+    def assertNotModified(self, url, etag):
+        self.assertEqual(self.client.get(url, headers={"If-None-Match": etag}).status_code, 304)
+
+    def test_unchanged_event_page_not_modified(self):
+        """
+        A matching If-None-Match is answered with 304 after a single query.
+        :return:
+        """
+        etag = self.client.get(self.event_url)["ETag"]
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertNotModified(self.event_url, etag)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_serving_write_changes_event_etag(self):
+        """
+        Claiming a serving changes the event page's ETag.
+        :return:
+        """
+        etag = self.client.get(self.event_url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            create_serving(order=self.order)
+        response = self.client.get(self.event_url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertNotModified(self.event_url, response["ETag"])
+
+    def test_claims_dont_write_event_row(self):
+        """
+        Claims change the event page's ETag through their order, without updating the event row they share lock.
+        :return:
+        """
+        etag = self.client.get(self.event_url)["ETag"]
+        with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks(execute=True):
+            create_serving(order=self.order)
+        self.assertFalse([q["sql"] for q in ctx.captured_queries if q["sql"].startswith('UPDATE "events_event"')])
+        self.assertNotEqual(self.client.get(self.event_url)["ETag"], etag)
+
+    def test_event_write_changes_org_etag(self):
+        """
+        Adding an event changes the organisation page's ETag.
+        :return:
+        """
+        etag = self.client.get(self.org_url)["ETag"]
+        self.assertNotModified(self.org_url, etag)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_event(self.org, name="Another")
+        self.assertEqual(self.client.get(self.org_url, headers={"If-None-Match": etag}).status_code, 200)
+
+    def test_etag_varies_by_user(self):
+        """
+        A page's ETag seen while logged out doesn't match once logged in.
+        :return:
+        """
+        etag = self.client.get(self.event_url)["ETag"]
+        self.client.force_login(OrgUser.objects.create_user(username="organiser", password="pw",
+                                                            organisation=self.org))
+        self.assertEqual(self.client.get(self.event_url, headers={"If-None-Match": etag}).status_code, 200)
+
+    def test_last_modified_only_for_anonymous_users(self):
+        """
+        Logged in users get no Last-Modified, and a date seen while logged out doesn't give them a 304.
+        :return:
+        """
+        last_modified = self.client.get(self.event_url)["Last-Modified"]
+        self.client.force_login(OrgUser.objects.create_user(username="organiser", password="pw",
+                                                            organisation=self.org))
+        response = self.client.get(self.event_url, headers={"If-Modified-Since": last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Last-Modified", response)
+
+
+class OrderCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+        self.other_order = create_order(event=self.event, purchaser_name="Alice")
+        self.url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+
+    def _render_cards(self):
+        with mock.patch("events.fragments.render_to_string", wraps=fragments.render_to_string) as render:
+            response = self.client.get(self.url)
+        return response, {call.args[1]["order"].pk for call in render.call_args_list}
+
+    def test_only_changed_card_rerendered(self):
+        """
+        Cached order cards are reused, only the card of an order that changed is rendered again.
+        :return:
+        """
+        self.assertEqual(self._render_cards()[1], {self.order.pk, self.other_order.pk})
+        self.assertEqual(self._render_cards()[1], set())
+        create_serving(order=self.order, buyer_name="Carol")
+        response, rendered = self._render_cards()
+        self.assertEqual(rendered, {self.order.pk})
+        self.assertContains(response, "Carol")
+
+    def test_locking_event_rerenders_cards(self):
+        """
+        Locking the event renders every card again, showing it as locked.
+        :return:
+        """
+        self._render_cards()
+        self.event.locked = True
+        self.event.save()
+        response, rendered = self._render_cards()
+        self.assertEqual(rendered, {self.order.pk, self.other_order.pk})
+        self.assertContains(response, 'id="new-servings-locked"', count=2)
+
+    def test_admin_controls_not_cached(self):
+        """
+        Cards cached for an anonymous visitor still show the organiser their delete buttons.
+        :return:
+        """
+        self._render_cards()
+        self.client.force_login(OrgUser.objects.create_user(username="organiser", password="pw",
+                                                            organisation=self.org))
+        self.assertContains(self.client.get(self.url), 'id="delete-order-btn"', count=2)
+
+    async def test_cards_rendered_off_event_loop(self):
+        """
+        Missing cards are rendered in a thread, so a cold cache doesn't block the event loop.
+        :return:
+        """
+        loops = []
+
+        def render(template_name, context):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return ""
+
+        with mock.patch("events.fragments.render_to_string", side_effect=render):
+            await fragments.aattach_order_cards([order async for order in Order.objects.filter(
+                event=self.event).with_claim_stats(servings=False)])
+        self.assertEqual(loops, [None, None])
+
+
+class MicrocacheTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+
+    def test_anonymous_page_cacheable_with_surrogate_keys(self):
+        """
+        Anonymous event pages are marked cacheable by nginx, with the organisation and event keys.
+        :return:
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response["X-Accel-Expires"], "5")
+        self.assertEqual(response["Surrogate-Key"], f"org-{self.org.path} event-{self.event.slug}")
+
+    def test_logged_in_page_not_cacheable(self):
+        """
+        Pages for logged in users are not marked cacheable.
+        :return:
+        """
+        self.client.force_login(OrgUser.objects.create_user(username="organiser", password="pw"))
+        self.assertNotIn("X-Accel-Expires", self.client.get(self.url))
+
+    @override_settings(MICROCACHE_PURGE_URL="http://nginx", MICROCACHE_PURGE_HOST="pizzapool.app",
+                       MICROCACHE_REFRESH_SECRET="refresh-secret")
+    def test_writes_refresh_pages(self):
+        """
+        A write queues a refresh of the event page, which re-fetches it through nginx.
+        :return:
+        """
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            create_serving(order=create_order(event=self.event))
+        task = Task.objects.get(name="events.microcache.refresh_pages")
+        self.assertEqual(task.kwargs, {"event_id": self.event.pk, "organisation_path": None})
+        with mock.patch("events.microcache.requests.get") as get:
+            tasks.run_next_task()
+        get.assert_called_once_with(f"http://nginx{self.url}", timeout=10, headers={
+            "X-Microcache-Refresh": "refresh-secret", "Host": "pizzapool.app"})
+
+
+class AsyncReadViewTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.user = OrgUser.objects.create_user(username="organiser", password="pw", organisation=self.org)
+        self.event = create_event(self.org, name="Members only")
+        create_serving(order=create_order(event=self.event), buyer_name="Carol")
+
+    def test_read_views_are_async(self):
+        """
+        The home, organisation and event pages are async views.
+        :return:
+        """
+        for view in (views.HomePage, views.OrgDetailView, views.EventDetailView):
+            self.assertTrue(view.view_is_async, view)
+
+    async def test_event_page(self):
+        """
+        The event page renders its orders and servings when served asynchronously.
+        :return:
+        """
+        url = reverse("events:event-detail", kwargs={"path": self.org.path, "slug": self.event.slug})
+        response = await self.async_client.get(url)
+        self.assertContains(response, "Carol")
+
+    async def test_org_page_shows_private_events_to_members(self):
+        """
+        Private events are only listed for the organisation's own users.
+        :return:
+        """
+        url = reverse("events:org-detail", kwargs={"path": self.org.path})
+        self.assertNotContains(await self.async_client.get(url), "Members only")
+        await self.async_client.aforce_login(self.user)
+        self.assertContains(await self.async_client.get(url), "Members only")
+
+
+class DatabaseSettingsCheckTests(TestCase):
+    def check_ids(self, **db):
+        with override_settings(DATABASES={'default': {**settings.DATABASES['default'], **db}}):
+            return [message.id for message in checks.check_connection_settings(None)]
+
+    @override_settings(SERVER_MODE='asgi')
+    def test_persistent_connections_rejected_under_asgi(self):
+        """
+        Persistent connections (CONN_MAX_AGE) are rejected under ASGI.
+        :return:
+        """
+        self.assertIn("events.E003", self.check_ids(CONN_MAX_AGE=60))
+        self.assertNotIn("events.E003", self.check_ids(CONN_MAX_AGE=0))
+
+    @override_settings(SERVER_MODE='wsgi')
+    def test_pool_rejects_persistent_connections(self):
+        """
+        CONN_MAX_AGE is rejected together with a connection pool.
+        :return:
+        """
+        self.assertIn("events.E002", self.check_ids(CONN_MAX_AGE=60, OPTIONS={'pool': {'max_size': 4}}))
+        self.assertEqual(self.check_ids(CONN_MAX_AGE=60, OPTIONS={}), [])
+
+    @override_settings(LIVE_UPDATES_BROKER='inprocess')
+    def test_inprocess_broker_rejected_with_several_workers(self):
+        """
+        The inprocess live updates broker can't reach viewers on other workers, so it needs a single worker.
+        :return:
+        """
+        with override_settings(WEB_CONCURRENCY=4):
+            self.assertIn("events.E005", self.check_ids())
+        with override_settings(WEB_CONCURRENCY=1):
+            self.assertNotIn("events.E005", self.check_ids())
+
+
+@override_settings(REPLICA_DATABASES=['replica_0'])
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+        self.router = routers.ReplicaRouter()
+
+    def read_db(self, state, fresh=True):
+        token = routers._state.set(state)
+        try:
+            # Test cases run inside a transaction, which always reads from default
+            with mock.patch.object(connections['default'], 'in_atomic_block', False), \
+                    mock.patch.object(routers, 'replica_is_fresh', return_value=fresh):
+                return self.router.db_for_read(Order)
+        finally:
+            routers._state.reset(token)
+
+    def test_reads_use_fresh_replicas_during_requests(self):
+        """
+        Request reads go to a replica within the lag tolerance, other reads and lagging replicas use default.
+        :return:
+        """
+        self.assertEqual(self.read_db(routers.RoutingState()), 'replica_0')
+        self.assertEqual(self.read_db(routers.RoutingState(), fresh=False), 'default')
+        self.assertEqual(self.read_db(None), 'default')
+        self.assertEqual(self.read_db(routers.RoutingState(pinned=True)), 'default')
+
+    def test_write_pins_later_reads(self):
+        """
+        Once a request writes, its later reads go to default.
+        :return:
+        """
+        state = routers.RoutingState()
+        token = routers._state.set(state)
+        try:
+            self.assertEqual(self.router.db_for_write(Order), 'default')
+        finally:
+            routers._state.reset(token)
+        self.assertTrue(state.wrote)
+        self.assertEqual(self.read_db(state), 'default')
+
+    @override_settings(REPLICA_DATABASES=[])
+    def test_claim_sets_pin_cookie(self):
+        """
+        Claiming servings pins the client to default, and the cookie pins its next request.
+        :return:
+        """
+        url = reverse("events:claim-servings", kwargs={"path": self.org.path, "pk": self.order.pk})
+        self.client.post(url, {"buyer_name": "John", "buyer_whatsapp": "0871234567", "number_of_servings": 1})
+        self.assertIn(routers.PIN_COOKIE, self.client.cookies)
+        request = mock.Mock(headers={})
+        request.get_signed_cookie.return_value = str(time.time() + 10)
+        self.assertTrue(routers.ReplicaRoutingMiddleware(lambda r: None).start(request).pinned)
+        request.get_signed_cookie.return_value = str(time.time() - 1)
+        self.assertFalse(routers.ReplicaRoutingMiddleware(lambda r: None).start(request).pinned)
+
+    @override_settings(MICROCACHE_REFRESH_SECRET="refresh-secret")
+    def test_only_authenticated_refreshes_pinned(self):
+        """
+        Microcache refreshes read from default only when they carry the shared secret.
+        :return:
+        """
+        def pinned(headers):
+            request = mock.Mock(headers=headers)
+            request.get_signed_cookie.side_effect = KeyError
+            return routers.ReplicaRoutingMiddleware(lambda r: None).start(request).pinned
+
+        self.assertTrue(pinned({"X-Microcache-Refresh": "refresh-secret"}))
+        self.assertFalse(pinned({"X-Microcache-Refresh": "1"}))
+        with override_settings(MICROCACHE_REFRESH_SECRET=""):
+            self.assertFalse(pinned({"X-Microcache-Refresh": ""}))
+
+    def test_replicas_never_migrated(self):
+        """
+        Migrations only run on default.
+        :return:
+        """
+        self.assertFalse(self.router.allow_migrate('replica_0', 'events'))
+        self.assertTrue(self.router.allow_migrate('default', 'events'))
+
+
+class OrganisationObjectViewTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+        self.user = OrgUser.objects.create_user(username="organiser", password="pw", organisation=self.org)
+
+    def lookups(self, method, url, table):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url)
+        selects = [q['sql'] for q in queries.captured_queries
+                   if q['sql'].startswith("SELECT") and f'FROM "{table}"' in q['sql']]
+        return response, len(selects)
+
+    def test_order_delete_loads_order_once(self):
+        """
+        Deleting an order looks it up once, with its event and organisation, for the check, the delete and redirect.
+        :return:
+        """
+        self.client.force_login(self.user)
+        url = reverse("events:order-delete", args=[self.org.path, self.event.slug, self.order.pk])
+        response, lookups = self.lookups("post", url, "events_order")
+        self.assertRedirects(response, reverse("events:event-detail", args=[self.org.path, self.event.slug]),
+                             fetch_redirect_response=False)
+        self.assertEqual(lookups, 1)
+        self.assertFalse(Order.objects.filter(pk=self.order.pk).exists())
+
+    def test_other_organisations_redirected(self):
+        """
+        Users of another organisation are sent to the event page after a single lookup.
+        :return:
+        """
+        other = OrgUser.objects.create_user(username="other", password="pw",
+                                            organisation=create_organisation(name="Other Org"))
+        self.client.force_login(other)
+        response, lookups = self.lookups("get", reverse("events:event-edit", args=[self.org.path, self.event.slug]),
+                                         "events_event")
+        self.assertRedirects(response, reverse("events:event-detail", args=[self.org.path, self.event.slug]),
+                             fetch_redirect_response=False)
+        self.assertEqual(lookups, 1)
+
+
+@override_settings(PRINCIPAL_CACHE_TIMEOUT=300)
+class CachedPrincipalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.org = create_organisation()
+        self.user = OrgUser.objects.create_user(username="organiser", password="pw", organisation=self.org)
+        self.backend = auth.CachedPrincipalBackend()
+
+    def test_user_cached_with_organisation(self):
+        """
+        The user is loaded with their organisation once, later requests use the cache.
+        :return:
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.organisation, self.org)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.backend.get_user(self.user.pk).organisation.name, self.org.name)
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_organisation_save_forgets_users(self):
+        """
+        Saving the organisation forgets its users once committed, so the next request sees the change.
+        :return:
+        """
+        self.backend.get_user(self.user.pk)
+        self.org.description = "New description"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.org.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).organisation.description, "New description")
+
+    def test_verification_update_forgets_users(self):
+        """
+        Stripe verification, stored with a queryset update, also forgets the organisation's users.
+        :return:
+        """
+        Organisation.objects.filter(pk=self.org.pk).update(stripe_account_id="acct_1")
+        self.backend.get_user(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            payments.set_account_verified("acct_1", True)
+        self.assertTrue(self.backend.get_user(self.user.pk).organisation.stripe_account_verified)
+
+    @override_settings(PRINCIPAL_CACHE_TIMEOUT=0)
+    def test_not_cached_by_default_with_local_cache(self):
+        """
+        With a local memory cache, which other processes can't invalidate, users are loaded on every request.
+        :return:
+        """
+        self.backend.get_user(self.user.pk)
+        self.assertIsNone(cache.get(auth.principal_key(self.user.pk)))
+        with override_settings(PRINCIPAL_CACHE_TIMEOUT=300):
+            self.assertIn("events.E006", [message.id for message in checks.check_connection_settings(None)])
+
+    def test_inactive_user_rejected(self):
+        """
+        A user deactivated after being cached is no longer authenticated.
+        :return:
+        """
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_sessions_from_model_backend_kept(self):
+        """
+        Sessions logged in before the cached backend was added stay logged in, and new logins use the cached backend.
+        :return:
+        """
+        self.client.force_login(self.user, backend="django.contrib.auth.backends.ModelBackend")
+        self.assertEqual(self.client.get(reverse("events:org-update", args=[self.org.path])).status_code, 200)
+        self.client.logout()
+        self.assertTrue(self.client.login(username="organiser", password="pw"))
+        self.assertEqual(self.client.session["_auth_user_backend"], "events.auth.CachedPrincipalBackend")
+
+
+class PhoneDisplayTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+        self.order = create_order(event=self.event)
+
+    def test_display_stored_on_save(self):
+        """
+        Saving an order or serving stores its number in the display format.
+        :return:
+        """
+        serving = create_serving(order=self.order, buyer_whatsapp="0871234567")
+        self.assertEqual(serving.buyer_whatsapp_display, "+353 87 123 4567")
+        self.assertEqual(self.order.purchaser_whatsapp_display, "+353 87 987 6543")
+
+    def test_event_page_shows_stored_numbers(self):
+        """
+        The event page shows the stored display numbers.
+        :return:
+        """
+        create_serving(order=self.order)
+        response = self.client.get(reverse("events:event-detail", args=[self.org.path, self.event.slug]))
+        self.assertContains(response, "+353 87 123 4567")
+        self.assertContains(response, "+353 87 987 6543")
+
+    def test_backfill_fills_missing_display(self):
+        """
+        backfill_phone_display stores the display format of rows saved without it and marks their orders changed.
+        :return:
+        """
+        serving = create_serving(order=self.order)
+        Serving.objects.filter(pk=serving.pk).update(buyer_whatsapp_display="")
+        Order.objects.filter(pk=self.order.pk).update(purchaser_whatsapp_display="")
+        version = Order.objects.get(pk=self.order.pk).version
+        call_command("backfill_phone_display", stdout=StringIO())
+        self.assertEqual(Serving.objects.get(pk=serving.pk).buyer_whatsapp_display, "+353 87 123 4567")
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.purchaser_whatsapp_display, "+353 87 987 6543")
+        self.assertGreater(order.version, version)
+
+
+class CascadeDeleteTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.event = create_event(self.org)
+
+    def seed(self, orders, servings_per_order):
+        created = Order.objects.bulk_create(
+            Order(event=self.event, purchaser_name="Bob", purchaser_whatsapp="+353879876543", purchaser_revolut="bob",
+                  description="Pep", price_per_serving=4, available_servings=servings_per_order,
+                  claimed_servings=servings_per_order)
+            for _ in range(orders))
+        Serving.objects.bulk_create(
+            (Serving(order=order, buyer_name="John", buyer_whatsapp="+353871234567", number_of_servings=1)
+             for order in created for _ in range(servings_per_order)), batch_size=5000)
+
+    def delete_event(self):
+        with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks():
+            deleted, counts = Event.objects.get(pk=self.event.pk).delete()
+        return deleted, counts, len(ctx.captured_queries)
+
+    def test_large_event_deleted_in_fixed_queries(self):
+        """
+        Deleting an event with 50k servings takes as many queries as one with a single serving, and removes everything.
+        :return:
+        """
+        create_serving(order=create_order(event=self.event))
+        *_, small_queries = self.delete_event()
+        self.event = create_event(self.org)
+        self.seed(orders=5000, servings_per_order=10)
+        deleted, counts, queries = self.delete_event()
+        self.assertEqual(queries, small_queries)
+        self.assertEqual(counts, {"events.Serving": 50000, "events.Order": 5000, "events.Event": 1})
+        self.assertEqual(deleted, 55001)
+        self.assertFalse(Event.objects.filter(pk=self.event.pk).exists())
+        self.assertFalse(Serving.objects.filter(order__event_id=self.event.pk).exists())
+
+    def test_event_delete_published_once(self):
+        """
+        The event's delete signals run once, not per order or serving.
+        :return:
+        """
+        self.seed(orders=3, servings_per_order=2)
+        broker = mock.Mock()
+        with mock.patch.object(live, "get_broker", return_value=broker):
+            with self.captureOnCommitCallbacks(execute=True):
+                Event.objects.get(pk=self.event.pk).delete()
+        self.assertEqual(broker.publish.call_count, 1)
+
+    def test_order_delete_removes_servings(self):
+        """
+        Deleting an order also deletes its servings and returns the counts per model.
+        :return:
+        """
+        order = create_order(event=self.event)
+        create_serving(order=order, number_of_servings=2)
+        self.assertEqual(order.delete(), (2, {"events.Serving": 1, "events.Order": 1}))
+        self.assertIsNone(order.pk)
+        self.assertFalse(Serving.objects.filter(order_id__isnull=False, order__event=self.event).exists())
+
+
+class EventArchiveTests(TestCase):
+    def setUp(self):
+        self.org = create_organisation()
+        self.old_event = create_event(self.org, name="Old Event", date=timezone.now() - timezone.timedelta(days=400))
+        self.order = create_order(event=self.old_event, description="Margherita")
+        create_serving(order=self.order, number_of_servings=2)
+        self.recent_event = create_event(self.org, name="Recent Event",
+                                         date=timezone.now() - timezone.timedelta(days=30))
+        Event.objects.filter(pk=self.old_event.pk).update(private=False)
+
+    def archive(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("archive_events", "--older-than-days", "365", stdout=StringIO())
+
+    def test_old_events_moved_to_archive(self):
+        """
+        Events past the cutoff are summarised into the archive and removed with their orders and servings.
+        :return:
+        """
+        slug = self.old_event.slug
+        self.archive()
+        archive = EventArchive.objects.get(slug=slug)
+        self.assertEqual(archive.name, "Old Event")
+        summary, = archive.orders
+        self.assertEqual(float(summary.pop("price_per_serving")), float(self.order.price_per_serving))
+        self.assertEqual(summary, {"purchaser_name": "Bob", "description": "Margherita", "claimed_servings": 2,
+                                   "available_servings": self.order.available_servings, "buyers": 1})
+        self.assertFalse(Event.objects.filter(pk=self.old_event.pk).exists())
+        self.assertFalse(Serving.objects.filter(order_id=self.order.pk).exists())
+        self.assertTrue(Event.objects.filter(pk=self.recent_event.pk).exists())
+
+    def test_archived_event_served_at_its_url(self):
+        """
+        The event page and the organisation's past events are served from the archive, without contact details.
+        :return:
+        """
+        url = reverse("events:event-detail", args=[self.org.path, self.old_event.slug])
+        self.archive()
+        response = self.client.get(url)
+        self.assertContains(response, "Margherita")
+        self.assertContains(response, "This event has been archived")
+        self.assertNotContains(response, "+353 87")
+        self.assertContains(self.client.get(reverse("events:org-detail", args=[self.org.path])), url)
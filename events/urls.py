@@ -13,10 +13,16 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(next_page=settings.LOGOUT_REDIRECT_URL), name='logout'),
     # Events
     path('user/<str:username>', views.UserView.as_view(), name='user'),
+    path('user/<str:username>/stripe-onboarding/', views.StripeOnboardingView.as_view(), name='stripe-onboarding'),
+    # Webhooks
+    path('webhooks/stripe/', views.StripeWebhookView.as_view(), name='stripe-webhook'),
+    # Monitoring
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
     path("<slug:path>/", views.OrgDetailView.as_view(), name="org-detail"),
     path("<slug:path>/edit/", views.OrgUpdateView.as_view(), name="org-update"),
     path("<slug:path>/create-event/", views.EventCreateView.as_view(), name="event-create"),
     path("<slug:path>/<slug>/", views.EventDetailView.as_view(), name="event-detail"),
+    path("<slug:path>/<slug>/stream/", views.EventStreamView.as_view(), name="event-stream"),
     path("<slug:path>/<slug>/edit/", views.EventEditView.as_view(), name="event-edit"),
     path("<slug:path>/<slug>/delete/", views.EventDeleteView.as_view(), name="event-delete"),
     path("<slug:path>/<slug>/create-order/", views.OrderCreateView.as_view(), name='create-pizza-order'),
@@ -1,21 +1,116 @@
+from asgiref.sync import sync_to_async
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.urls import reverse_lazy
+from django.db import connections
+from django.db.models import Count, Max, Q, Sum
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.decorators import method_decorator
 from django.views import generic
-from django.shortcuts import render, redirect, get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.views.generic import DeleteView, TemplateView
 from django.conf import settings
 import stripe
 
-from .models import OrgUser, Organisation, Event, Order, Serving
+from . import fragments, live, metrics, payments
+from .microcache import MicrocacheMixin, event_key, org_key
+from .models import OrgUser, Organisation, Event, EventArchive, Order, Serving, ClaimStatus, claim_servings
 from .forms import OrderCreateForm, ServingCreateForm, OrgUpdateForm, EventEditForm, EventCreateForm
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 
+class ConditionalGetMixin:
+    """
+    Answers If-None-Match / If-Modified-Since with 304 Not Modified before the page is loaded or rendered, for an
+    AsyncDetailView. get_validators() returns (version, last modified datetime) from a single cheap query, or None if
+    the object doesn't exist. The ETag also covers the viewing user, as the page shows their username and admin
+    controls, and Last-Modified is only sent to anonymous visitors.
+    """
+
+    async def get_validators(self):
+        raise NotImplementedError
+
+    async def get(self, request, *args, **kwargs):
+        validators = await self.get_validators()
+        if validators is None:
+            return await super().get(request, *args, **kwargs)
+        version, last_modified = validators
+        user = await request.auser()
+        etag = quote_etag(f"{version}-{last_modified.timestamp()}-{user.pk}-{getattr(user, 'organisation_id', None)}")
+        # Last-Modified can't tell users apart, a page cached while logged out would be reused after logging in
+        last_modified = None if user.is_authenticated else int(last_modified.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await super().get(request, *args, **kwargs)
+        response.headers.setdefault("ETag", etag)
+        if last_modified is not None:
+            response.headers.setdefault("Last-Modified", http_date(last_modified))
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class AsyncDetailView(generic.DetailView):
+    """
+    DetailView served asynchronously: the user, object and context are loaded with the async ORM and the returned
+    TemplateResponse is rendered by the handler. Subclasses override aget_context_data() rather than
+    get_context_data() for anything that queries the database.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        self.object = await self.aget_object()
+        context = await self.aget_context_data(object=self.object)
+        return self.render_to_response(context)
+
+    async def aget_object(self):
+        return await aget_object_or_404(self.get_queryset(),
+                                        **{self.get_slug_field(): self.kwargs.get(self.slug_url_kwarg)})
+
+    async def aget_context_data(self, **kwargs):
+        return self.get_context_data(**kwargs)
+
+
+class OrganisationObjectMixin:
+    """
+    For views changing an object that belongs to an organisation. The object is loaded once per request, together
+    with the objects along organisation_field up to its organisation, and reused by the permission check, the form
+    and the redirects. test_func() passes the organisation's own users.
+    """
+    organisation_field = None
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return queryset.select_related(self.organisation_field) if self.organisation_field else queryset
+
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super().get_object(queryset)
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
+
+    def get_organisation(self):
+        obj = self.get_object()
+        if self.organisation_field:
+            for field in self.organisation_field.split('__'):
+                obj = getattr(obj, field)
+        return obj
+
+    def test_func(self):
+        return self.request.user.organisation_id == self.get_organisation().pk
+
+
 class HomePage(TemplateView):
     template_name = "events/homepage.html"
 
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        return self.render_to_response(self.get_context_data(**kwargs))
+
 
 class UserView(generic.DetailView):
     model = OrgUser
@@ -25,71 +120,109 @@ class UserView(generic.DetailView):
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
-        # If linked stripe verification = false, recheck account verification
-        if not self.object.organisation.stripe_account_verified:
-            #  Check if charges and payouts are enabled
-            account = stripe.Account.retrieve(self.object.organisation.stripe_account_id)
-            if account["charges_enabled"] and account["payouts_enabled"]:
-                # Update account if verified
-                self.object.organisation.stripe_account_verified = True
-                self.object.organisation.save()
+        # If linked stripe verification = false, recheck account verification in the background
+        if self.object.organisation:
+            payments.schedule_verification_refresh(self.object.organisation)
         context = self.get_context_data(object=self.object)
         return self.render_to_response(context)
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['stripe_link'] = self.get_stripe_setup_link()
-        return context
 
-    def get_stripe_setup_link(self):
-        protocol = 'https' if self.request.is_secure() else 'http'
-        host = self.request.get_host()
-        base_url = f"{protocol}://{host}"
+class StripeOnboardingView(LoginRequiredMixin, UserPassesTestMixin, generic.RedirectView):
+    """Creates a Stripe onboarding link only when it is clicked, verified organisations go to the dashboard"""
+
+    def test_func(self):
+        organisation = self.request.user.organisation
+        return (self.request.user.username == self.kwargs['username']
+                and organisation is not None and bool(organisation.stripe_account_id))
+
+    def handle_no_permission(self):
+        if not self.request.user.is_authenticated:
+            return super().handle_no_permission()
+        return redirect("events:user", username=self.kwargs['username'])
+
+    def get_redirect_url(self, *args, **kwargs):
+        organisation = self.request.user.organisation
+        if organisation.stripe_account_verified:
+            return settings.STRIPE_DASHBOARD_URL
+        return_url = self.request.build_absolute_uri(reverse("events:user", args=[self.request.user.username]))
         link = stripe.AccountLink.create(
-            account=self.object.organisation.stripe_account_id,
-            refresh_url=f"{base_url}/user/{self.object.username}",
-            return_url=f"{base_url}/user/{self.object.username}",
+            account=organisation.stripe_account_id,
+            refresh_url=return_url,
+            return_url=return_url,
             type="account_onboarding",
             collection_options={"fields": "eventually_due"},
         )
         return link["url"]
 
 
-class OrgDetailView(generic.DetailView):
+@method_decorator(csrf_exempt, name="dispatch")
+class StripeWebhookView(generic.View):
+    """Stripe webhook endpoint, disabled until STRIPE_WEBHOOK_SECRET is set, as anyone can sign with an empty key"""
+
+    def post(self, request, *args, **kwargs):
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            raise Http404
+        try:
+            event = stripe.Webhook.construct_event(
+                request.body, request.headers.get("Stripe-Signature", ""), settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, stripe.SignatureVerificationError):
+            return HttpResponse(status=400)
+        payments.handle_webhook_event(event)
+        return HttpResponse(status=200)
+
+
+class MetricsView(generic.View):
+    """Prometheus metrics, see events.metrics. Requires METRICS_TOKEN as a bearer token if one is set."""
+
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404
+        if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+            return HttpResponse(status=403)
+        content, content_type = metrics.render_latest()
+        return HttpResponse(content, content_type=content_type)
+
+
+class OrgDetailView(MicrocacheMixin, ConditionalGetMixin, AsyncDetailView):
     model = Organisation
     template_name = "events/organisation_detail.html"
     slug_field = "path"
     slug_url_kwarg = "path"
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    def get_surrogate_keys(self):
+        return [org_key(self.kwargs['path'])]
+
+    async def get_validators(self):
+        # The number of past events changes the page as events move from current to past
+        org = await Organisation.objects.filter(path=self.kwargs['path']).annotate(
+            past_events=Count('event', filter=Q(event__date__lt=timezone.now()))
+        ).values('version', 'updated_at', 'past_events').afirst()
+        if org is None:
+            return None
+        return f"{org['version']}.{org['past_events']}", org['updated_at']
+
+    async def aget_context_data(self, **kwargs):
+        context = await super().aget_context_data(**kwargs)
         user = self.request.user
         today = timezone.now()
         # Hide private events unless org user is logged in
-        filter_kwargs_gte = dict(organisation=self.object, date__gte=today)
-        filter_kwargs_lt = dict(organisation=self.object, date__lt=today)
-        if user.is_anonymous or self.object != user.organisation:
-            filter_kwargs_gte['private'] = False
-            filter_kwargs_lt['private'] = False
-        context['current_events'] = Event.objects.filter(**filter_kwargs_gte)
-        context['past_events'] = Event.objects.filter(**filter_kwargs_lt)
+        include_private = user.is_authenticated and self.object.pk == user.organisation_id
+        events = Event.objects.listed(self.object, include_private)
+        context['current_events'] = [event async for event in events.filter(date__gte=today)]
+        context['past_events'] = [event async for event in events.filter(date__lt=today)]
+        context['past_events'] += [event async for event in EventArchive.objects.listed(self.object, include_private)]
         return context
 
 
-class OrgUpdateView(LoginRequiredMixin, UserPassesTestMixin, generic.UpdateView):
+class OrgUpdateView(OrganisationObjectMixin, LoginRequiredMixin, UserPassesTestMixin, generic.UpdateView):
     model = Organisation
     form_class = OrgUpdateForm
     template_name = "events/organisation_edit.html"
     slug_field = "path"
     slug_url_kwarg = "path"
 
-    def test_func(self):
-        org = self.get_object()
-        return self.request.user.organisation == org
-
     def handle_no_permission(self):
-        org = self.get_object()
-        return redirect("events:org-detail", path=org.path)
+        return redirect("events:org-detail", path=self.get_object().path)
 
     def get_success_url(self):
         return reverse_lazy("events:org-detail", kwargs={"path": self.object.path})
@@ -113,25 +246,92 @@ class EventCreateView(LoginRequiredMixin, generic.CreateView):
         return reverse_lazy("events:org-detail", kwargs={"path": self.request.user.organisation.path})
 
 
-class EventDetailView(generic.DetailView):
+class EventDetailView(MicrocacheMixin, ConditionalGetMixin, AsyncDetailView):
     model = Event
     template_name = "events/event_detail.html"
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        orders = Order.objects.filter(event=self.object)
-        context['orders'] = orders
+    def get_surrogate_keys(self):
+        return [org_key(self.kwargs['path']), event_key(self.kwargs['slug'])]
+
+    async def get_validators(self):
+        # Every claim or cancellation bumps its order's version and updated_at, so the orders' count, summed versions
+        # and latest update cover them without writing the event row, which claims hold a share lock on. The page
+        # also shows the organisation's name and logo.
+        event = await Event.objects.filter(slug=self.kwargs['slug']).annotate(
+            orders=Count('order'), order_versions=Sum('order__version'), orders_updated_at=Max('order__updated_at'),
+        ).values('updated_at', 'organisation__updated_at', 'orders', 'order_versions', 'orders_updated_at').afirst()
+        if event is None:
+            return None
+        last_modified = max(event['updated_at'], event['organisation__updated_at'],
+                            event['orders_updated_at'] or event['updated_at'])
+        return f"{event['orders']}.{event['order_versions'] or 0}", last_modified
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            return await super().get(request, *args, **kwargs)
+        except Http404:
+            # Old events are moved to the archive by the archive_events command
+            if not await EventArchive.objects.filter(slug=self.kwargs['slug']).aexists():
+                raise
+            return await ArchivedEventView.as_view()(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('organisation')
+
+    async def aget_context_data(self, **kwargs):
+        context = await super().aget_context_data(**kwargs)
+        orders = [order async for order in Order.objects.filter(event=self.object).with_claim_stats(servings=False)]
+        context['orders'] = await fragments.aattach_order_cards(orders)
+        context['live_updates'] = settings.SERVER_MODE == 'asgi'  # see EventStreamView
         return context
 
 
-class EventEditView(LoginRequiredMixin, UserPassesTestMixin, generic.UpdateView):
+class ArchivedEventView(MicrocacheMixin, ConditionalGetMixin, AsyncDetailView):
+    """An archived event's read-only summary, served by EventDetailView at the event's URL, see events.archive"""
+    model = EventArchive
+    template_name = "events/event_archive.html"
+    context_object_name = "event"
+
+    def get_surrogate_keys(self):
+        return [org_key(self.kwargs['path']), event_key(self.kwargs['slug'])]
+
+    async def get_validators(self):
+        # Archives don't change, but the page shows the organisation's name and logo
+        event = await EventArchive.objects.filter(slug=self.kwargs['slug']).values(
+            'pk', 'archived_at', 'organisation__updated_at').afirst()
+        if event is None:
+            return None
+        return f"archive.{event['pk']}", max(event['archived_at'], event['organisation__updated_at'])
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('organisation')
+
+
+class EventStreamView(generic.View):
+    """
+    Server-sent events stream of order and serving changes for an event page, see events.live. Only served under ASGI:
+    WSGI buffers an async stream to its end, which never comes, holding a worker thread per viewer.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        if settings.SERVER_MODE != 'asgi':
+            # 204 tells EventSource clients not to reconnect
+            return HttpResponse(status=204)
+        event = await aget_object_or_404(Event, slug=self.kwargs['slug'])
+        # The stream can stay open for an hour without querying, so give the connection back (to the pool) now, as
+        # request_finished only closes it when the stream ends
+        await sync_to_async(connections.close_all)()
+        response = StreamingHttpResponse(live.stream_deltas(event.pk), content_type="text/event-stream")
+        response['Cache-Control'] = "no-cache"
+        response['X-Accel-Buffering'] = "no"
+        return response
+
+
+class EventEditView(OrganisationObjectMixin, LoginRequiredMixin, UserPassesTestMixin, generic.UpdateView):
     model = Event
     form_class = EventEditForm
     template_name = "events/event_edit.html"
-
-    def test_func(self):
-        event = self.get_object()
-        return self.request.user.organisation == event.organisation
+    organisation_field = "organisation"
 
     def handle_no_permission(self):
         event = self.get_object()
@@ -142,13 +342,10 @@ class EventEditView(LoginRequiredMixin, UserPassesTestMixin, generic.UpdateView)
         return reverse_lazy("events:event-detail", kwargs={"path": event.organisation.path, "slug": event.slug})
 
 
-class EventDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class EventDeleteView(OrganisationObjectMixin, LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Event
     template_name = "events/event_delete.html"
-
-    def test_func(self):
-        event = self.get_object()
-        return self.request.user.organisation == event.organisation
+    organisation_field = "organisation"
 
     def handle_no_permission(self):
         event = self.get_object()
@@ -188,13 +385,10 @@ class OrderCreateView(generic.CreateView):
                             kwargs={"path": self.event.organisation.path, "slug": self.event.slug})
 
 
-class OrderDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
+class OrderDeleteView(OrganisationObjectMixin, LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Order
     template_name = "events/order_delete.html"
-
-    def test_func(self):
-        order = self.get_object()
-        return self.request.user.organisation == order.event.organisation
+    organisation_field = "event__organisation"
 
     def handle_no_permission(self):
         order = self.get_object()
@@ -227,8 +421,15 @@ class ServingCreateView(generic.CreateView):
         return context
 
     def form_valid(self, form):
-        form.instance.order = self.order
-        return super().form_valid(form)
+        result = claim_servings(self.order, **form.cleaned_data)
+        if result.status == ClaimStatus.LOCKED:
+            form.add_error(None, "This event is locked, servings can no longer be claimed.")
+            return self.form_invalid(form)
+        if result.status == ClaimStatus.INSUFFICIENT:
+            form.add_error('number_of_servings', "There are not enough servings remaining in this order.")
+            return self.form_invalid(form)
+        self.object = result.serving
+        return redirect(self.get_success_url())
 
     def get_success_url(self):
         return reverse_lazy("events:event-detail", kwargs={
@@ -237,9 +438,10 @@ class ServingCreateView(generic.CreateView):
         })
 
 
-class ServingDeleteView(DeleteView):
+class ServingDeleteView(OrganisationObjectMixin, DeleteView):
     model = Serving
     template_name = "events/delete_slices.html"
+    organisation_field = "order__event__organisation"
 
     def get_success_url(self):
         servings = self.get_object()
@@ -0,0 +1,42 @@
+"""
+Gunicorn configuration, used by entrypoint.sh.
+
+SERVER_MODE selects how Django is served:
+- "asgi" (default): uvicorn workers running pizzapool.asgi, one per CPU. Async views (the organisation, event and home
+  pages, and the live event streams) wait on the database and network without tying up the worker.
+- "wsgi": threaded sync workers running pizzapool.wsgi, 2 x CPUs + 1 processes of GUNICORN_THREADS threads each.
+WEB_CONCURRENCY overrides the number of worker processes in either mode. settings.py applies the same defaults, so
+that live updates go through Postgres (LIVE_UPDATES_BROKER) whenever there is more than one worker.
+"""
+import multiprocessing
+import os
+
+server_mode = os.environ.get("SERVER_MODE", "asgi")
+cpus = multiprocessing.cpu_count()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+if server_mode == "asgi":
+    wsgi_app = "pizzapool.asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    workers = int(os.environ.get("WEB_CONCURRENCY", cpus))
+elif server_mode == "wsgi":
+    wsgi_app = "pizzapool.wsgi:application"
+    worker_class = "gthread"
+    workers = int(os.environ.get("WEB_CONCURRENCY", cpus * 2 + 1))
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))
+else:
+    raise RuntimeError(f"Unknown SERVER_MODE {server_mode!r}, expected 'asgi' or 'wsgi'")
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then so a slow leak can't build up, staggered so they don't all restart together
+max_requests = 2000
+max_requests_jitter = 200
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live metrics files, see events/metrics.py
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
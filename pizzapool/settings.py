@@ -9,10 +9,12 @@ https://docs.djangoproject.com/en/5.0/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
+import multiprocessing
 import os
 import environ
 import certifi
 import ssl
+import sys
 from pathlib import Path
 from email.utils import parseaddr
 import logging
@@ -68,6 +70,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'events.profiling.ProfilingMiddleware',
+    'events.metrics.MetricsMiddleware',
+    'events.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -96,21 +101,82 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'pizzapool.wsgi.application'
+# "asgi" or "wsgi", see gunicorn.conf.py
+SERVER_MODE = env('SERVER_MODE', default='asgi')
+# Gunicorn worker processes, with the same defaults as gunicorn.conf.py
+CPUS = multiprocessing.cpu_count()
+WEB_CONCURRENCY = env.int('WEB_CONCURRENCY', default=CPUS if SERVER_MODE == 'asgi' else CPUS * 2 + 1)
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Connection reuse, checked at startup by events.checks:
+# - DB_POOL: psycopg 3 connection pool per worker process, the right choice under ASGI and on by default there
+#   unless behind PgBouncer. Each request in progress holds one connection (live event streams give theirs back
+#   before streaming, see EventStreamView), so DB_POOL_MAX_SIZE bounds a worker's concurrent requests. Off by
+#   default under manage.py test, whose concurrency tests run more threads than the pool holds
+# - DB_CONN_MAX_AGE: persistent connections (seconds, 0 closes after each request), only safe with sync workers as
+#   ASGI requests run in a new thread each time. Defaults to 60 under WSGI.
+# - DB_PGBOUNCER: connecting through PgBouncer in transaction mode, which doesn't support server-side cursors or
+#   startup parameters, so set statement_timeout on the database role instead
+DB_PGBOUNCER = env.bool('DB_PGBOUNCER', default=False)
+TESTING = sys.argv[1:2] == ['test']
+DB_POOL = env.bool('DB_POOL', default=SERVER_MODE == 'asgi' and not DB_PGBOUNCER and not TESTING)
+DB_STATEMENT_TIMEOUT = env.int('DB_STATEMENT_TIMEOUT', default=30000)  # milliseconds, 0 for none
+DB_OPTIONS = {}
+if DB_STATEMENT_TIMEOUT and not DB_PGBOUNCER:
+    DB_OPTIONS['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+if DB_POOL:
+    DB_OPTIONS['pool'] = {
+        'min_size': env.int('DB_POOL_MIN_SIZE', default=2),
+        'max_size': env.int('DB_POOL_MAX_SIZE', default=10),
+        'timeout': env.int('DB_POOL_TIMEOUT', default=10),  # seconds to wait for a free connection
+    }
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'django.db.backends.postgresql',
         'NAME': env('DB_NAME'),
         'USER': env('DB_USER'),
         'PASSWORD': env('DB_PASSWORD'),
         'HOST': env('DB_HOST'),
         'PORT': env('DB_PORT'),
+        'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', default=60 if SERVER_MODE == 'wsgi' and not DB_POOL else 0),
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': DB_PGBOUNCER,
+        'OPTIONS': DB_OPTIONS,
     }
 }
 
+# Read replicas (host or host:port, same name and credentials as default), see events.routers. Reads during a request
+# go to a replica lagging at most REPLICA_MAX_LAG seconds; a client that writes reads from default for the next
+# REPLICA_STICKY_SECONDS
+REPLICA_DATABASES = []
+for i, replica in enumerate(env.list('DB_REPLICA_HOSTS', default=[])):
+    host, _, port = replica.partition(':')
+    REPLICA_DATABASES.append(f'replica_{i}')
+    DATABASES[f'replica_{i}'] = {**DATABASES['default'], 'HOST': host, 'PORT': port or DATABASES['default']['PORT'],
+                                 'TEST': {'MIRROR': 'default'}}
+REPLICA_MAX_LAG = env.float('REPLICA_MAX_LAG', default=5)
+REPLICA_STICKY_SECONDS = env.int('REPLICA_STICKY_SECONDS', default=15)
+REPLICA_LAG_CHECK_INTERVAL = env.float('REPLICA_LAG_CHECK_INTERVAL', default=2)
+DATABASE_ROUTERS = ['events.routers.ReplicaRouter']
+
+# Cache
+# Local memory (per process) by default, which suits a single node. With several nodes point CACHE_BACKEND and
+# CACHE_LOCATION at a shared cache, e.g. django.core.cache.backends.redis.RedisCache and redis://redis:6379
+CACHES = {
+    'default': {
+        'BACKEND': env('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env('CACHE_LOCATION', default='pizzapool'),
+        'TIMEOUT': env.int('CACHE_TIMEOUT', default=300),
+    },
+}
+# Rendered order cards on the event page (events.fragments). Keys change on every write, so entries only expire to
+# free space
+ORDER_CARD_CACHE = env('ORDER_CARD_CACHE', default='default')
+ORDER_CARD_CACHE_TIMEOUT = env.int('ORDER_CARD_CACHE_TIMEOUT', default=3600)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -133,7 +199,10 @@ AUTH_PASSWORD_VALIDATORS = [
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
 # Email settings
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Mail is queued as a background task (see events.tasks) and sent by the run_workers command through
+# TASK_EMAIL_BACKEND, so requests never wait on the SMTP server
+EMAIL_BACKEND = env('EMAIL_BACKEND', default='events.mail.QueuedEmailBackend')
+TASK_EMAIL_BACKEND = env('TASK_EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = env('EMAIL_HOST')
 EMAIL_PORT = env.int('EMAIL_PORT')
 EMAIL_USE_TLS = env.bool('EMAIL_USE_TLS')
@@ -154,6 +223,13 @@ USE_TZ = True
 
 # Custom User Auth
 AUTH_USER_MODEL = 'events.OrgUser'
+# The logged in user and their organisation are cached for PRINCIPAL_CACHE_TIMEOUT seconds (events.auth), only with a
+# shared cache: invalidation has to reach every web and task worker process. ModelBackend stays listed for sessions
+# from before it was added, which name it as their backend and would otherwise be logged out
+AUTHENTICATION_BACKENDS = ['events.auth.CachedPrincipalBackend', 'django.contrib.auth.backends.ModelBackend']
+LOCAL_CACHE_BACKENDS = ['django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache']
+PRINCIPAL_CACHE_TIMEOUT = env.int('PRINCIPAL_CACHE_TIMEOUT',
+                                  default=0 if CACHES['default']['BACKEND'] in LOCAL_CACHE_BACKENDS else 300)
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
@@ -177,6 +253,51 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 PHONENUMBER_DEFAULT_FORMAT = "INTERNATIONAL"
 PHONENUMBER_DEFAULT_REGION = 'IE'
 
+# Request profiling: Server-Timing header with SQL, template and Stripe time on every response, and a warning logged
+# (with the slowest queries) for requests over REQUEST_PROFILING_SLOW_MS
+REQUEST_PROFILING = env.bool('REQUEST_PROFILING', default=False)
+REQUEST_PROFILING_SLOW_MS = env.int('REQUEST_PROFILING_SLOW_MS', default=500)
+REQUEST_PROFILING_TOP_QUERIES = env.int('REQUEST_PROFILING_TOP_QUERIES', default=5)
+
+# Prometheus metrics at /metrics (see events.metrics). Set the PROMETHEUS_MULTIPROC_DIR environment variable to share
+# them between gunicorn and task worker processes
+METRICS_ENABLED = env.bool('METRICS_ENABLED', default=True)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Anonymous full-page microcache in nginx (events.microcache, nginx/nginx.conf). MICROCACHE_SECONDS = 0 turns it off.
+# With MICROCACHE_PURGE_URL set (the nginx base URL as seen from the task workers, e.g. http://nginx) pages are
+# refreshed there after writes, sent with MICROCACHE_PURGE_HOST as the Host header. It must pass ALLOWED_HOSTS, and
+# defaults to the first allowed host. Refreshes carry MICROCACHE_REFRESH_SECRET, which nginx and
+# events.routers check before bypassing the cache and reading from the primary, and are only sent with one set
+MICROCACHE_SECONDS = env.int('MICROCACHE_SECONDS', default=5)
+MICROCACHE_PURGE_URL = env('MICROCACHE_PURGE_URL', default='')
+MICROCACHE_PURGE_HOST = env('MICROCACHE_PURGE_HOST',
+                            default=next((host.lstrip('.') for host in ALLOWED_HOSTS if host != '*'), ''))
+MICROCACHE_REFRESH_SECRET = env('MICROCACHE_REFRESH_SECRET', default='')
+
+# Events dated more than EVENT_ARCHIVE_AFTER_DAYS ago are moved to read-only summaries by the archive_events command
+EVENT_ARCHIVE_AFTER_DAYS = env.int('EVENT_ARCHIVE_AFTER_DAYS', default=365)
+
+# Background tasks (python manage.py run_workers)
+TASK_WORKERS = env.int('TASK_WORKERS', default=4)
+TASK_POLL_INTERVAL = env.float('TASK_POLL_INTERVAL', default=1.0)
+TASK_RETRY_BACKOFF = env.int('TASK_RETRY_BACKOFF', default=10)  # seconds, doubled after each failed attempt
+TASK_RETRY_BACKOFF_MAX = env.int('TASK_RETRY_BACKOFF_MAX', default=3600)
+TASK_TIMEOUT = env.int('TASK_TIMEOUT', default=600)  # seconds before a running task is assumed lost and retried
+
+# Notification emails are coalesced per recipient over this many seconds, then sent over one connection
+NOTIFICATION_WINDOW = env.int('NOTIFICATION_WINDOW', default=60)
+NOTIFICATION_BATCH_SIZE = env.int('NOTIFICATION_BATCH_SIZE', default=500)
+
+# Live event page updates: "inprocess" for a single worker, "postgres" (LISTEN/NOTIFY) for several
+LIVE_UPDATES_BROKER = env('LIVE_UPDATES_BROKER', default='inprocess' if WEB_CONCURRENCY == 1 else 'postgres')
+LIVE_UPDATES_HEARTBEAT = env.int('LIVE_UPDATES_HEARTBEAT', default=15)
+
 # Stripe configuration
 STRIPE_PUBLIC_KEY = env('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY')
+# The webhook endpoint answers 404 until this is set
+STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET', default='')
+STRIPE_DASHBOARD_URL = env('STRIPE_DASHBOARD_URL', default='https://dashboard.stripe.com/')
+# Minimum seconds between background rechecks of an unverified account
+STRIPE_VERIFICATION_TTL = env.int('STRIPE_VERIFICATION_TTL', default=300)